@@ -0,0 +1,75 @@
+import sys
+import argparse
+
+
+from lib import benchmark
+from lib import getinput
+
+
+#==================================================INPUT==============================================================================#
+#seed scenarios of the benchmark and of golden outputs
+scenarioFolders = getinput.discoverScenarios("./input/")
+#==================================================/INPUT==============================================================================#
+
+#==================================================PARAMETERS==============================================================================#
+stabilityClass = ["A", "B", "C", "D", "E", "F"]
+#resolutions of the domain (single source stages and field stack of seed sources up to maxStackResolution)
+resolutions = [50, 100, 200, 500, 1000, 2000]
+maxStackResolution = 1000
+#numbers of sources (field stack and optimization at resolution sourceResolution)
+sourceCounts = [6, 10, 100, 1000]
+sourceResolution = 100
+#smaller benchmark (--quick)
+quickResolutions = [50, 100, 200]
+quickSourceCounts = [6, 100]
+#stage is reported as regression, if it is more than regressionThreshold times slower than in baseline
+regressionThreshold = 1.25
+resultsFile = "./output/benchmark_results.json"
+baselineFile = "./benchmark/baseline.json"
+goldenFile = "./benchmark/golden.npz"
+#==================================================/PARAMETERS==============================================================================#
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline stages and check of golden outputs")
+    parser.add_argument("--quick", action="store_true", help="smaller sweep of resolutions and numbers of sources")
+    parser.add_argument("--save-baseline", action="store_true", help="store results as new baseline")
+    parser.add_argument("--save-golden", action="store_true", help="store outputs of the current code and reference fields of the scalar code as new golden outputs")
+    parser.add_argument("--golden-only", action="store_true", help="only check golden outputs, without benchmark")
+    args = parser.parse_args()
+
+    #===============================GOLDEN=OUTPUTS============================================================================================#
+    if args.save_golden:
+        benchmark.saveGolden(scenarioFolders, stabilityClass, goldenFile)
+        print("Golden outputs stored in", goldenFile)
+    checks = benchmark.checkGolden(scenarioFolders, goldenFile)
+    for check in checks:
+        print("Golden output", check["scenario"], check["output"], ": error", check["error"], ("passed" if check["passed"] else "FAILED"))
+    failed = not all(check["passed"] for check in checks)
+    #===============================/GOLDEN=OUTPUTS===========================================================================================#
+
+    #===============================BENCHMARK=================================================================================================#
+    if not args.golden_only:
+        results = []
+        for scenarioFolder in scenarioFolders:
+            results += benchmark.runBenchmark(scenarioFolder, quickResolutions if args.quick else resolutions, quickSourceCounts if args.quick else sourceCounts,
+                                              stabilityClass, sourceResolution, maxStackResolution)
+        benchmark.saveResults(results, resultsFile)
+        for result in results:
+            print(result["scenario"], result["stage"], "resolution", result["resolution"], "sources", result["sourceCount"], ": time [s]", round(result["time"], 4))
+        if args.save_baseline:
+            benchmark.saveResults(results, baselineFile)
+            print("Baseline stored in", baselineFile)
+        else:
+            try:
+                comparisons = benchmark.compareResults(results, benchmark.loadResults(baselineFile), regressionThreshold)
+            except FileNotFoundError:
+                comparisons = []
+                print("No baseline in", baselineFile, "(store it with --save-baseline)")
+            for comparison in comparisons:
+                if comparison["regression"]:
+                    print("REGRESSION:", comparison["scenario"], comparison["stage"], "resolution", comparison["resolution"], "sources", comparison["sourceCount"],
+                          ": time [s]", round(comparison["time"], 4), "baseline", round(comparison["baselineTime"], 4))
+            failed = failed or any(comparison["regression"] for comparison in comparisons)
+    #===============================/BENCHMARK================================================================================================#
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import platform
+import tempfile
+import numpy as np
+from numpy.typing import NDArray
+
+
+from lib import domain
+from lib import ge
+from lib import getinput
+from lib import output
+from lib import parallel
+
+
+#Benchmark and regression checks of the dispersion and optimization pipeline
+#Benchmark: run time of each stage of the pipeline for several resolutions of the domain and numbers of sources,
+#           results are stored in json file and compared with stored baseline results.
+#Golden outputs: cumulative imission matrix, optimal power outputs and concentration fields for optimal power combination
+#           of seed scenarios stored in .npz file, so that changed (faster) computation can be checked to reproduce them.
+#           Golden outputs are produced by the code which stores them, so they guard only against changes. Independent check
+#           is the reference field stack at small resolution referenceResolution, computed node by node by the original scalar
+#           code (ge.gaussDispEqDomain with method "loop"), against which the vectorized field stack is compared.
+#           Rotated plume kernel (finer wind roses) is checked at referenceResolution against direct evaluation of its sectors.
+#           Other engines of the field stack (sparse, streaming, parallel, cached, receptors) are checked at referenceResolution
+#           against the dense field stack.
+
+#golden concentration fields are stored in every goldenStep-th node in both directions (to keep the stored file small,
+#cumulative imissions are checked from all nodes)
+goldenStep = 4
+
+#resolution of the reference field stack computed by the original scalar code (slow, so small resolution is used)
+referenceResolution = 15
+
+#number of sectors of the finer wind rose for the check of rotated plume kernel (each sector of the scenario wind rose is split
+#into sectors of equal share) and bound of its maximal node error, relative to maximal concentration (see ge.rotationKernelError)
+rotatedSectorCount = 16
+rotatedTolerance = 5e-3
+
+#plume tolerance of the sparse engine check (ge.computeFieldStack with tolerance) - error of each node is lower than tolerance
+#times plume centerline concentration, so the field stack must agree with the dense one within this tolerance
+sparseTolerance = 1e-4
+#number of worker processes of the parallel engine check
+engineWorkers = 2
+
+#stages of the pipeline which are timed, with the swept quantity ("resolution" or "sourceCount")
+benchmarkStages = ["getinput", "gaussDispEqDomain", "gaussDispEq_TotalConcField", "computeCumulativeImission", "computeFieldStack", "minimizeImissions", "createGraphs"]
+
+
+def timeCall(function, *args, repeat: int = 1, **kwargs) -> float:
+    #Return the shortest run time [s] of repeat calls of function(*args, **kwargs)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def synthesizeSources(sourceParams_all: list[list[float]], sourceCount: int, seed: int = 0) -> list[list[float]]:
+    #Create scenario with sourceCount sources from seed scenario: main source and distributed sources of the seed scenario,
+    #further sources are copies of distributed sources at random positions in the domain (reproducible for given seed)
+    rng = np.random.default_rng(seed)
+    sources = [list(sourceParams) for sourceParams in sourceParams_all[:sourceCount]]
+    distributed = sourceParams_all[1:] if len(sourceParams_all) > 1 else sourceParams_all
+    while len(sources) < sourceCount:
+        sourceParams = list(distributed[(len(sources) - 1) % len(distributed)])
+        sourceParams[0:2] = rng.uniform(0.05, 0.95, size=2).tolist()
+        sources.append(sourceParams)
+    return sources
+
+
+def runBenchmark(scenarioFolder: str, resolutions: list[int], sourceCounts: list[int], stabilityClasses: list[str], sourceResolution: int = 100, maxStackResolution: int = 1000, repeat: int = 1) -> list[dict]:
+    #Time stages of the pipeline (benchmarkStages) for the seed scenario
+    #single source stages and the whole pipeline with seed sources are timed for each resolution from resolutions
+    #(field stack only up to maxStackResolution), field stack and optimization for each number of sources from sourceCounts
+    #at resolution sourceResolution
+    #Return list of results {"stage", "scenario", "resolution", "sourceCount", "time"}
+    results = []
+    def record(stage: str, n: int, sourceCount: int, runTime: float) -> None:
+        results.append({"stage": stage, "scenario": scenarioFolder, "resolution": n, "sourceCount": sourceCount, "time": runTime})
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        domainParams, dispersionParams, sourceParams_all = getinput.getScenario(scenarioFolder)
+    record("getinput", domainParams[2], len(sourceParams_all), (time.perf_counter() - start)/repeat)
+
+    for n in resolutions:
+        domainParams_n = list(domainParams[0:2]) + [n]
+        record("gaussDispEqDomain", n, 1, timeCall(ge.gaussDispEqDomain, sourceParams_all[0], 2, dispersionParams, domainParams_n, domain.windDirections[0], stabilityClasses[0], repeat=repeat))
+        record("gaussDispEq_TotalConcField", n, 1, timeCall(ge.gaussDispEq_TotalConcField, sourceParams_all[0], dispersionParams, domainParams_n, stabilityClasses[0], repeat=repeat))
+        record("computeCumulativeImission", n, 1, timeCall(ge.computeCumulativeImission, sourceParams_all[0], dispersionParams, domainParams_n, stabilityClasses[0], repeat=repeat))
+        if n <= maxStackResolution:
+            record("computeFieldStack", n, len(sourceParams_all), timeCall(ge.computeFieldStack, sourceParams_all, dispersionParams, domainParams_n, stabilityClasses, repeat=repeat))
+        concField = ge.gaussDispEq_TotalConcField(sourceParams_all[0], dispersionParams, domainParams_n, stabilityClasses[0])
+        record("createGraphs", n, 1, timeCall(output.renderGraphs, [(concField, "benchmark", "Benchmark")], domainParams_n, workers=1, repeat=repeat))
+        for plotType in output.plotTypes:
+            os.remove("./output/benchmark_" + plotType + ".png")
+
+    for sourceCount in sourceCounts:
+        sources = synthesizeSources(sourceParams_all, sourceCount)
+        domainParams_n = list(domainParams[0:2]) + [sourceResolution]
+        record("computeFieldStack", sourceResolution, sourceCount, timeCall(ge.computeFieldStack, sources, dispersionParams, domainParams_n, stabilityClasses, repeat=repeat))
+        cumulativeImission = ge.computeFieldStack(sources, dispersionParams, domainParams_n, stabilityClasses)
+        record("minimizeImissions", sourceResolution, sourceCount, timeCall(ge.minimizeImissions, cumulativeImission, ge.powerShareCoef(sources), repeat=repeat))
+    return results
+
+
+def saveResults(results: list[dict], fileName: str) -> None:
+    #Save benchmark results into json file, with information about the machine
+    report = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__,
+              "platform": platform.platform(), "cpuCount": os.cpu_count(), "results": results}
+    with open(fileName, "w") as f:
+        json.dump(report, f, indent=1)
+
+
+def loadResults(fileName: str) -> list[dict]:
+    #Load benchmark results saved by saveResults
+    with open(fileName) as f:
+        return json.load(f)["results"]
+
+
+def compareResults(results: list[dict], baseline: list[dict], threshold: float = 1.25) -> list[dict]:
+    #Compare benchmark results with baseline results (same stage, scenario, resolution and number of sources)
+    #Return list of comparisons {"stage", "scenario", "resolution", "sourceCount", "time", "baselineTime", "ratio", "regression"},
+    #regression is True if the stage is more than threshold times slower than in baseline
+    baselineTimes = {(result["stage"], result["scenario"], result["resolution"], result["sourceCount"]): result["time"] for result in baseline}
+    comparisons = []
+    for result in results:
+        baselineTime = baselineTimes.get((result["stage"], result["scenario"], result["resolution"], result["sourceCount"]))
+        if baselineTime is None:
+            continue
+        ratio = result["time"]/baselineTime if baselineTime > 0 else float("inf")
+        comparisons.append(dict(result, baselineTime=baselineTime, ratio=ratio, regression=ratio > threshold))
+    return comparisons
+
+
+def goldenOutputs(scenarioFolder: str, stabilityClasses: list[str]) -> dict[str, NDArray[np.float64]]:
+    #Compute outputs of the pipeline for the scenario (at resolution from domain.txt):
+    #cumulative imission matrix [stability class, source], optimal power outputs (linprog) and
+    #concentration fields for optimal power combination [stability class, i, j] (in every goldenStep-th node)
+    domainParams, dispersionParams, sourceParams_all = getinput.getScenario(scenarioFolder)
+    cumulativeImission, totalConcFields = ge.computeFieldStack(sourceParams_all, dispersionParams, domainParams, stabilityClasses, returnFields=True)
+    sourcePowerOutputs = ge.minimizeImissions(cumulativeImission, ge.powerShareCoef(sourceParams_all))
+    return {"cumulativeImission": cumulativeImission,
+            "powerOutputs": sourcePowerOutputs,
+            "optimalFields": np.tensordot(totalConcFields[:,:,::goldenStep,::goldenStep], sourcePowerOutputs, axes=([1],[0]))}
+
+
+def referenceFieldStack(scenarioFolder: str, stabilityClasses: list[str], n: int = referenceResolution) -> NDArray[np.float64]:
+    #Compute field stack [stability class, source, i, j] weighted by wind rose (as ge.computeFieldStack with returnFields=True)
+    #at resolution n, node by node by the original scalar gaussian plume equation (ge.gaussDispEqDomain with method "loop")
+    domainParams, dispersionParams, sourceParams_all = getinput.getScenario(scenarioFolder)
+    domainParams_n = list(domainParams[0:2]) + [n]
+    totalConcFields = np.zeros(shape = (len(stabilityClasses), len(sourceParams_all), n, n))
+    #scalar code evaluates dispersion coefficients also for up-wind nodes (negative distance), before they are set to 0
+    with np.errstate(invalid="ignore"):
+        for i in range(len(stabilityClasses)):
+            for indx, sourceParams in enumerate(sourceParams_all):
+                for k, windDirection in enumerate(domain.windDirections):
+                    totalConcFields[i, indx] += dispersionParams[2+k]*ge.gaussDispEqDomain(sourceParams, 2, dispersionParams, domainParams_n, windDirection, stabilityClasses[i], method="loop")
+    return totalConcFields
+
+
+def rotatedKernelError(scenarioFolder: str, stabilityClasses: list[str], sectorCount: int = rotatedSectorCount, n: int = referenceResolution) -> float:
+    #Return maximal node error of ge.gaussDispEq_TotalConcFieldRotated (see ge.rotationKernelError) over all sources
+    #and stability classes of the scenario, for its wind rose split into sectorCount sectors, at resolution n
+    domainParams, dispersionParams, sourceParams_all = getinput.getScenario(scenarioFolder)
+    split = sectorCount//len(domain.windDirections)
+    rotatedDispersionParams = list(dispersionParams[0:2]) + list(np.repeat(dispersionParams[2:], split)/split)
+    return max(ge.rotationKernelError(sourceParams, rotatedDispersionParams, list(domainParams[0:2]) + [n], stabilityClass)["maxError"]
+               for sourceParams in sourceParams_all for stabilityClass in stabilityClasses)
+
+
+def engineErrors(scenarioFolder: str, stabilityClasses: list[str], n: int = referenceResolution) -> dict[str, float]:
+    #Compare other engines of the field stack with the dense field stack (ge.computeFieldStack) of the scenario at resolution n:
+    #  "sparse" - only nodes inside plume wedges (ge.computeFieldStack with tolerance sparseTolerance)
+    #  "streamFields", "streamImission" - streaming by blocks of rows (ge.streamImissionStats with fields of single sources)
+    #  "computeCumulativeImission" - cumulative imission of single sources (ge.computeCumulativeImission)
+    #  "parallel" - parallel.computeFieldStackParallel with engineWorkers workers
+    #  "cached" - ge.computeFieldStack with new field cache (fields computed and stored) and with the same cache again (fields loaded)
+    #  "receptors" - ge.gaussDispEqReceptors in all nodes of the domain
+    #Return maximal error of each engine, relative to the largest field value (or cumulative imission) of the dense field stack
+    domainParams, dispersionParams, sourceParams_all = getinput.getScenario(scenarioFolder)
+    domainParams_n = list(domainParams[0:2]) + [n]
+    cumulativeImission, totalConcFields = ge.computeFieldStack(sourceParams_all, dispersionParams, domainParams_n, stabilityClasses, returnFields=True)
+    fieldError = lambda fields: float(np.max(np.abs(fields - totalConcFields))/np.max(totalConcFields))
+    imissionError = lambda imission: float(np.max(np.abs(imission - cumulativeImission))/np.max(cumulativeImission))
+    errors = {}
+    errors["sparse"] = fieldError(ge.computeFieldStack(sourceParams_all, dispersionParams, domainParams_n, stabilityClasses, returnFields=True, tolerance=sparseTolerance)[1])
+    streamStats = [ge.streamImissionStats(sourceParams_all, dispersionParams, domainParams_n, stabilityClass, np.eye(len(sourceParams_all)), returnFields=True) for stabilityClass in stabilityClasses]
+    errors["streamFields"] = fieldError(np.array([stats["fields"] for stats in streamStats]))
+    errors["streamImission"] = imissionError(np.array([stats["cumulativeImission"] for stats in streamStats]))
+    errors["computeCumulativeImission"] = imissionError(np.array([[ge.computeCumulativeImission(sourceParams, dispersionParams, domainParams_n, stabilityClass)
+                                                                   for sourceParams in sourceParams_all] for stabilityClass in stabilityClasses]))
+    errors["parallel"] = fieldError(parallel.computeFieldStackParallel(sourceParams_all, dispersionParams, domainParams_n, stabilityClasses, returnFields=True, workers=engineWorkers)[1])
+    with tempfile.TemporaryDirectory() as cacheDir:
+        errors["cached"] = max(fieldError(ge.computeFieldStack(sourceParams_all, dispersionParams, domainParams_n, stabilityClasses, returnFields=True, cacheDir=cacheDir)[1])
+                               for _ in range(2))
+    x_point_domainCoor, y_point_domainCoor = domain.createDomainCoor(n)
+    receptors = np.stack([x_point_domainCoor.ravel(), y_point_domainCoor.ravel(), np.full(n*n, 2.0)], axis=1)
+    receptorConc = ge.gaussDispEqReceptors(sourceParams_all, dispersionParams, domainParams_n, stabilityClasses, receptors)
+    errors["receptors"] = fieldError(receptorConc.reshape(totalConcFields.shape))
+    return errors
+
+
+def saveGolden(scenarioFolders: list[str], stabilityClasses: list[str], goldenFile: str) -> None:
+    #Store golden outputs (see goldenOutputs) and reference field stack (see referenceFieldStack) of all scenarios
+    #into one compressed .npz file
+    golden = {"stabilityClasses": np.array(stabilityClasses)}
+    for scenarioFolder in scenarioFolders:
+        scenarioName = os.path.basename(os.path.normpath(scenarioFolder))
+        for outputName, values in goldenOutputs(scenarioFolder, stabilityClasses).items():
+            golden[scenarioName + "/" + outputName] = values
+        golden[scenarioName + "/referenceFields"] = referenceFieldStack(scenarioFolder, stabilityClasses)
+    np.savez_compressed(goldenFile, **golden)
+
+
+def checkGolden(scenarioFolders: list[str], goldenFile: str, rtol: float = 1e-9, shareTolerance: float = 1e-6) -> list[dict]:
+    #Compare outputs of the current code with golden outputs stored by saveGolden, and vectorized field stack
+    #(ge.computeFieldStack) at referenceResolution with the reference field stack of the scalar code
+    #fields and cumulative imissions must agree within relative tolerance rtol (relative to the largest value),
+    #optimal power outputs within absolute tolerance shareTolerance and rotated plume kernel within rotatedTolerance
+    #Other engines of the field stack (see engineErrors) must agree with the dense field stack within rtol
+    #(sparse engine within sparseTolerance)
+    #Return list of checks {"scenario", "output", "error", "tolerance", "passed"}
+    checks = []
+    with np.load(goldenFile) as golden:
+        stabilityClasses = [str(stabilityClass) for stabilityClass in golden["stabilityClasses"]]
+        for scenarioFolder in scenarioFolders:
+            scenarioName = os.path.basename(os.path.normpath(scenarioFolder))
+            outputs = goldenOutputs(scenarioFolder, stabilityClasses)
+            domainParams, dispersionParams, sourceParams_all = getinput.getScenario(scenarioFolder)
+            outputs["referenceFields"] = ge.computeFieldStack(sourceParams_all, dispersionParams, list(domainParams[0:2]) + [referenceResolution], stabilityClasses, returnFields=True)[1]
+            for outputName, values in outputs.items():
+                expected = golden[scenarioName + "/" + outputName]
+                if outputName == "powerOutputs":
+                    error, tolerance = float(np.max(np.abs(values - expected))), shareTolerance
+                else:
+                    error, tolerance = float(np.max(np.abs(values - expected))/np.max(np.abs(expected))), rtol
+                checks.append({"scenario": scenarioName, "output": outputName, "error": error, "tolerance": tolerance, "passed": error <= tolerance})
+            error = rotatedKernelError(scenarioFolder, stabilityClasses)
+            checks.append({"scenario": scenarioName, "output": "rotatedKernel", "error": error, "tolerance": rotatedTolerance, "passed": error <= rotatedTolerance})
+            for engineName, error in engineErrors(scenarioFolder, stabilityClasses).items():
+                tolerance = sparseTolerance if engineName == "sparse" else rtol
+                checks.append({"scenario": scenarioName, "output": "engine/" + engineName, "error": error, "tolerance": tolerance, "passed": error <= tolerance})
+    return checks
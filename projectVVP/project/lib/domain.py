@@ -2,13 +2,49 @@ import numpy as np
 from numpy.typing import NDArray
 
 
+#wind directions of the wind rose, in the order of their percentage shares in dispersionParams[2:10]
+#(as used by ge.gaussDispEq_TotalConcField)
+windDirections = ["N", "NW", "W", "SW", "S", "SE", "E", "NE"]
+#down-wind unit vector (direction of x axis of source-wind coordinate system used by domainToSourceCoor) in domain coordinates
+windDirectionVectors = {
+    "N": (0.0, 1.0),
+    "NW": (-np.sqrt(2)/2, np.sqrt(2)/2),
+    "W": (-1.0, 0.0),
+    "SW": (-np.sqrt(2)/2, -np.sqrt(2)/2),
+    "S": (0.0, -1.0),
+    "SE": (np.sqrt(2)/2, -np.sqrt(2)/2),
+    "E": (1.0, 0.0),
+    "NE": (np.sqrt(2)/2, np.sqrt(2)/2),
+}
+
+
+def windSectorAngles(sectorCount: int) -> NDArray[np.float64]:
+    #Return down-wind direction (angle in radians from x axis of the domain, counter-clockwise) of each sector of a wind rose
+    #with sectorCount sectors. Sectors are ordered as windDirections (N, NW, W, ...), so for 8 sectors
+    #angles correspond to windDirectionVectors and for finer wind roses (16, 36 sectors) sectors follow in the same rotation.
+    return np.pi/2 + 2*np.pi*np.arange(sectorCount)/sectorCount
+
+
 def createDomainMatrix(n: int) -> NDArray[np.float64]:
     #create concentration field matrix, according to domain parameters
     return np.zeros(shape = (n,n))
 
+def createDomainCoor(n: int, rowStart: int = 0, rowStop: int | None = None) -> tuple[NDArray[np.float64], NDArray[np.float64]]:
+    #create matrices of relative coordinates (numbers from <0,1>) of all domain nodes
+    #node [i,j] has x coordinate j/(n-1) and y coordinate ((n-1)-i)/(n-1), i.e. first row of the matrix is upper edge of a domain
+    #if rowStart, rowStop are given, only coordinates of rows rowStart, ..., rowStop-1 (block of the domain) are created
+    if rowStop is None:
+        rowStop = n
+    nodes = np.arange(n)
+    rows = np.arange(rowStart, rowStop)
+    x_point_domainCoor = np.broadcast_to(nodes/(n-1), (len(rows),n))
+    y_point_domainCoor = np.broadcast_to((((n-1) - rows)/(n-1))[:,np.newaxis], (len(rows),n))
+    return x_point_domainCoor, y_point_domainCoor
+
 def domainToSourceCoor(x_point_domainCoor: float, y_point_domainCoor: float, sourceParams: list, domainParams: list, windDirection: str ) ->tuple[float, float]:
     #coordinates of point and source are defined as number from <0,1>, where 0 is left (lower) edge of a domain
     #and 1 is right (upper) edge
+    #coordinates of point can be also given as numpy arrays (e.g. from createDomainCoor), then arrays of coordinates are returned
     #windDirection is defined as one of the following strings "N", "NW", "W", "SW", "S", "SE", "E" and "NE"
     #each string represents corresponding direction of standard wind rose (i.e. north, north-west, west and so on) 
     #Return x and y coordinates in source-wind coordinate system 
@@ -40,4 +76,12 @@ def domainToSourceCoor(x_point_domainCoor: float, y_point_domainCoor: float, sou
             x_sourceCoor = (np.sqrt(2)/2) * (x_point_domainCoor-sourceParams[0]) + (np.sqrt(2)/2) * (y_point_domainCoor-sourceParams[1])
             y_sourceCoor = (-1)*(np.sqrt(2)/2) * (x_point_domainCoor-sourceParams[0]) + (np.sqrt(2)/2) * (y_point_domainCoor-sourceParams[1])
         
-    return 1000*domainParams[0]*x_sourceCoor, 1000*domainParams[1]*y_sourceCoor
\ No newline at end of file
+    return 1000*domainParams[0]*x_sourceCoor, 1000*domainParams[1]*y_sourceCoor
+
+def domainToSourceCoorAngle(x_point_domainCoor, y_point_domainCoor, sourceParams: list, domainParams: list, angle: float) -> tuple:
+    #Same as domainToSourceCoor, but down-wind direction is given by angle (in radians, see windSectorAngles)
+    #instead of one of 8 wind rose directions
+    #Return x and y coordinates in source-wind coordinate system (in m)
+    x_sourceCoor = np.cos(angle) * (x_point_domainCoor-sourceParams[0]) + np.sin(angle) * (y_point_domainCoor-sourceParams[1])
+    y_sourceCoor = np.abs(-np.sin(angle) * (x_point_domainCoor-sourceParams[0]) + np.cos(angle) * (y_point_domainCoor-sourceParams[1]))
+    return 1000*domainParams[0]*x_sourceCoor, 1000*domainParams[1]*y_sourceCoor
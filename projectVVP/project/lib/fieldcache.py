@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+import numpy as np
+from numpy.typing import NDArray
+
+
+#Persistent cache of concentration fields at unit emission rate (1 g/s)
+#Concentration is linear in emission rate sourceParams[6], so fields at unit emission can be reused for any emission rate
+#(and for any wind rose shares, as fields are stored separately for each wind direction).
+#Each cached file holds fields of one source for one stability class, for all wind directions [wind direction, i, j]
+#and is named by hash of all inputs which change the shape of the field.
+
+#change when the dispersion model changes, so that old cached fields are not used
+cacheVersion = 1
+
+
+def fieldKey(sourceParams: list[float], dispersionParams: list[float], domainParams: list[float], stabilityClass: str, zCoor: float, windDirections: list[str], tolerance: float | None = None) -> str:
+    #Return hash identifying unit emission fields of one source
+    #key contains domain geometry and resolution, source position and stack parameters (sourceParams[0:6]),
+    #atmospheric temperature and wind velocity, stability class, height of computed points and wind directions
+    #emission rate (sourceParams[6]) and wind rose shares (dispersionParams[2:]) are not part of the key
+    #tolerance of sparse (plume wedge) evaluation is part of the key only when it is used
+    keyData = [cacheVersion,
+               [float(value) for value in domainParams[0:3]],
+               [float(value) for value in sourceParams[0:6]],
+               [float(value) for value in dispersionParams[0:2]],
+               stabilityClass, float(zCoor), list(windDirections)]
+    if tolerance is not None:
+        keyData.append(float(tolerance))
+    return hashlib.sha256(json.dumps(keyData).encode()).hexdigest()
+
+
+def loadFields(cacheDir: str, key: str) -> NDArray[np.float64] | None:
+    #Return memory-mapped cached fields for given key, or None if they are not in the cache
+    fileName = os.path.join(cacheDir, key + ".npy")
+    try:
+        fields = np.load(fileName, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        return None
+    #mark file as recently used (for eviction of least recently used files)
+    os.utime(fileName)
+    return fields
+
+
+def saveFields(cacheDir: str, key: str, fields: NDArray[np.float64]) -> None:
+    #Store unit emission fields under given key
+    os.makedirs(cacheDir, exist_ok=True)
+    fileName = os.path.join(cacheDir, key + ".npy")
+    #write to temporary file first, so that incomplete file is never loaded (e.g. from concurrent runs)
+    tmpFileName = fileName + "." + str(os.getpid()) + ".tmp"
+    with open(tmpFileName, "wb") as f:
+        np.save(f, fields)
+    os.replace(tmpFileName, fileName)
+
+
+def evict(cacheDir: str, maxBytes: int) -> None:
+    #Delete least recently used cached files, until size of the cache is at most maxBytes
+    if not os.path.isdir(cacheDir):
+        return
+    cachedFiles = []
+    for entry in os.scandir(cacheDir):
+        if entry.name.endswith(".npy"):
+            stat = entry.stat()
+            cachedFiles.append((stat.st_mtime, stat.st_size, entry.path))
+    cachedFiles.sort()
+    cacheSize = sum(size for mtime, size, path in cachedFiles)
+    for mtime, size, path in cachedFiles:
+        if cacheSize <= maxBytes:
+            break
+        os.remove(path)
+        cacheSize -= size
@@ -1,11 +1,54 @@
 # Module: ge.py
+import time
 import numpy as np
 import scipy.optimize as spopt
-import matplotlib.pyplot as plt
+import scipy.ndimage as spimg
+import scipy.fft
 from numpy.typing import NDArray
 
 
 from lib import domain
+from lib import fieldcache
+from lib import instrument
+
+
+#Gifford's urban dispersion coefficients: L,M,N parameters for each stability class [Baychok. M, Fundamentals of stack gas dispersion, 1979]
+sigma_z_classCoef = {
+    "A": [240, 1.0, 0.5],
+    "B": [240, 1.0, 0.5],
+    "C": [200, 0.0, 0.0],
+    "D": [140, 0.3, -0.5],
+    "E": [80, 1.5, -0.5],
+    "F": [80, 1.5, -0.5],
+}
+sigma_y_classCoef = {
+    "A": [320, 0.4, -0.5],
+    "B": [320, 0.4, -0.5],
+    "C": [220, 0.4, -0.5],
+    "D": [160, 0.4, -0.5],
+    "E": [110, 0.4, -0.5],
+    "F": [110, 0.4, -0.5],
+}
+
+
+def dispersionCoef(xCoor, stabilityClass: str) -> tuple:
+    #Compute vertical and horizontal dispersion coefficients, 
+    #using Gifford's urban dispersion coefficients equation [Baychok. M, Fundamentals of stack gas dispersion, 1979]
+    #xCoor is downwind distance from the source in m, as a single value or an array of values
+    #Return sigma_z and sigma_y (same shape as xCoor)
+    sigma_zCoef = sigma_z_classCoef[stabilityClass]
+    sigma_yCoef = sigma_y_classCoef[stabilityClass]
+    sigma_z = (sigma_zCoef[0]*(xCoor/1000))*(1+sigma_zCoef[1]*(xCoor/1000))**sigma_zCoef[2]
+    sigma_y = (sigma_yCoef[0]*(xCoor/1000))*(1+sigma_yCoef[1]*(xCoor/1000))**sigma_yCoef[2]
+    return sigma_z, sigma_y
+
+
+def effectivePlumeHeight(xCoor, sourceParams: list[float], dispersionParams: list[float]):
+    #Compute effective stack height
+    #using Briggs equation for bent-over, buoyant plume [Baychok. M, Fundamentals of stack gas dispersion, 1979]
+    #xCoor is downwind distance from the source in m, as a single value or an array of values
+    F = 9.807 * sourceParams[4] * (sourceParams[3]**2) * ( (sourceParams[5] - dispersionParams[0])/sourceParams[5] )
+    return 1.6 * np.power(F, 1/3) * np.power(xCoor,2/3) * (1/dispersionParams[1])
 
 
 def gaussDispEq(xCoor: float, yCoor: float, zCoor: float, sourceParams: list[float], dispersionParams: list[float], stabilityClass: str) -> float:
@@ -14,51 +57,12 @@ def gaussDispEq(xCoor: float, yCoor: float, zCoor: float, sourceParams: list[flo
     #Return one concentration value for specified point [xCoor, yCoor]
 
     #===================================DISPERSION COEFFIENTS===================================================#
-    #Compute vertical and horizontal dispersion coefficients, 
-    #using Gifford's urban dispersion coefficients equation [Baychok. M, Fundamentals of stack gas dispersion, 1979]
-    #Gifford's urban dispersion coefficients: L,M,N parameters for A stability class
-    #xCoor and yCoor are defined as downwind distance from the source (x) and croswind distance from downwind line passing through the source (y)
-    sigma_z_AclassCoef = [240, 1.0, 0.5]
-    sigma_z_BclassCoef = [240, 1.0, 0.5]
-    sigma_z_CclassCoef = [200, 0.0, 0.0]
-    sigma_z_DclassCoef = [140, 0.3, -0.5]
-    sigma_z_EclassCoef = [80, 1.5, -0.5]
-    sigma_z_FclassCoef = [80, 1.5, -0.5]
-
-    sigma_y_AclassCoef = [320, 0.4, -0.5]
-    sigma_y_BclassCoef = [320, 0.4, -0.5]
-    sigma_y_CclassCoef = [220, 0.4, -0.5]
-    sigma_y_DclassCoef = [160, 0.4, -0.5]
-    sigma_y_EclassCoef = [110, 0.4, -0.5]
-    sigma_y_FclassCoef = [110, 0.4, -0.5]
-
     #vertical and horizontal dispersion coeff.
-    match stabilityClass:
-        case "A":
-            sigma_z = (sigma_z_AclassCoef[0]*(xCoor/1000))*(1+sigma_z_AclassCoef[1]*(xCoor/1000))**sigma_z_AclassCoef[2]
-            sigma_y = (sigma_y_AclassCoef[0]*(xCoor/1000))*(1+sigma_y_AclassCoef[1]*(xCoor/1000))**sigma_y_AclassCoef[2]
-        case "B":
-            sigma_z = (sigma_z_BclassCoef[0]*(xCoor/1000))*(1+sigma_z_BclassCoef[1]*(xCoor/1000))**sigma_z_BclassCoef[2]
-            sigma_y = (sigma_y_BclassCoef[0]*(xCoor/1000))*(1+sigma_y_BclassCoef[1]*(xCoor/1000))**sigma_y_BclassCoef[2]
-        case "C":
-            sigma_z = (sigma_z_CclassCoef[0]*(xCoor/1000))*(1+sigma_z_CclassCoef[1]*(xCoor/1000))**sigma_z_CclassCoef[2]
-            sigma_y = (sigma_y_CclassCoef[0]*(xCoor/1000))*(1+sigma_y_CclassCoef[1]*(xCoor/1000))**sigma_y_CclassCoef[2]
-        case "D":
-            sigma_z = (sigma_z_DclassCoef[0]*(xCoor/1000))*(1+sigma_z_DclassCoef[1]*(xCoor/1000))**sigma_z_DclassCoef[2]
-            sigma_y = (sigma_y_DclassCoef[0]*(xCoor/1000))*(1+sigma_y_DclassCoef[1]*(xCoor/1000))**sigma_y_DclassCoef[2]
-        case "E":
-            sigma_z = (sigma_z_EclassCoef[0]*(xCoor/1000))*(1+sigma_z_EclassCoef[1]*(xCoor/1000))**sigma_z_EclassCoef[2]
-            sigma_y = (sigma_y_EclassCoef[0]*(xCoor/1000))*(1+sigma_y_EclassCoef[1]*(xCoor/1000))**sigma_y_EclassCoef[2]
-        case "F":
-            sigma_z = (sigma_z_FclassCoef[0]*(xCoor/1000))*(1+sigma_z_FclassCoef[1]*(xCoor/1000))**sigma_z_FclassCoef[2]
-            sigma_y = (sigma_y_FclassCoef[0]*(xCoor/1000))*(1+sigma_y_FclassCoef[1]*(xCoor/1000))**sigma_y_FclassCoef[2]
+    sigma_z, sigma_y = dispersionCoef(xCoor, stabilityClass)
     #===================================/DISPERSION COEFFIENTS===================================================#
 
     #===================================EFFECTIVE=STACK=HEIGHT===================================================#
-    #Compute effective stack height
-    #using Briggs equation for bent-over, buoyant plume [Baychok. M, Fundamentals of stack gas dispersion, 1979]
-    F = 9.807 * sourceParams[4] * (sourceParams[3]**2) * ( (sourceParams[5] - dispersionParams[0])/sourceParams[5] )
-    effPlumeHeight = 1.6 * np.power(F, 1/3) * np.power(xCoor,2/3) * (1/dispersionParams[1])
+    effPlumeHeight = effectivePlumeHeight(xCoor, sourceParams, dispersionParams)
     #===================================/EFFECTIVE=STACK=HEIGHT===================================================#
 
     #===================================COMPUTE=CONCENTRATION========================================================#
@@ -72,10 +76,74 @@ def gaussDispEq(xCoor: float, yCoor: float, zCoor: float, sourceParams: list[flo
     return C #*1000000 converting from g.m-3 to micrograms.m-3 (imission limit is formulated in micrograms.m-3)
     #===================================/COMPUTE=CONCENTRATION========================================================#
 
-def gaussDispEqDomain(sourceParams: list[float], zCoor: float, dispersionParams: list[float], domainParams: list[float], windDirection: str, stabilityClass: str) -> NDArray[np.float64]:
+def gaussDispEqArray(xCoor: NDArray[np.float64], yCoor: NDArray[np.float64], zCoor, sourceParams: list[float], dispersionParams: list[float], stabilityClass: str) -> NDArray[np.float64]:
+    #Array version of gaussDispEq - compute concentrations for all points given by xCoor, yCoor arrays in one numpy pass
+    #(xCoor, yCoor in m in source-centered coordinate system, zCoor in m above the terrain - single value or array)
+    #Arguments are broadcast against each other, elements of sourceParams can be also arrays (e.g. one value per source)
+    #Points upwind from the source (xCoor <= 0) are masked and their concentration is 0, as in gaussDispEq
+    #Return array of concentrations with the broadcast shape of the inputs
+    upwind = np.asarray(xCoor) <= 0
+    #dummy downwind distance for masked points, so that no invalid values are computed for them
+    xCoor = np.where(upwind, 1.0, xCoor)
+    sigma_z, sigma_y = dispersionCoef(xCoor, stabilityClass)
+    effPlumeHeight = effectivePlumeHeight(xCoor, sourceParams, dispersionParams)
+    horizontalDispTerm = np.power(np.e, (-(yCoor**2)/(2*(np.power(sigma_y,2)))))
+    verticalDispTerm = ( np.e**(-((zCoor-effPlumeHeight)**2)/(2*(sigma_z**2))) ) + (np.e**(-((zCoor+effPlumeHeight)**2)/(2*(sigma_z**2))))
+    C = (sourceParams[6]/(dispersionParams[1] * sigma_y * sigma_z * 2 * np.pi)) * horizontalDispTerm  * verticalDispTerm
+    return np.where(upwind, 0.0, C)
+
+def plumeRegion(sourceParams: list[float], dispersionParams: list[float], domainParams: list[float], windDirection: str, stabilityClass: str, tolerance: float) -> tuple[slice, slice]:
+    #Find region of the domain where concentration from the source can exceed tolerance (relative to plume centerline)
+    #Plume is non-negligible only down-wind from the source and inside the wedge |y| <= k*sigma_y(x), where k = sqrt(2*ln(1/tolerance)),
+    #outside of it horizontalDispTerm is lower than tolerance. sigma_y grows with x, so the wedge is contained in rectangle
+    #given by the source, the most down-wind point of the domain and the wedge half-width k*sigma_y at this point.
+    #Return row and column slices of domain matrix (bounding box of the rectangle)
+    n = domainParams[2]
+    #the most down-wind distance of the domain (in one of its corners)
+    cornersXCoor, cornersYCoor = domain.domainToSourceCoor(np.array([0.0, 1.0, 0.0, 1.0]), np.array([0.0, 0.0, 1.0, 1.0]), sourceParams, domainParams, windDirection)
+    xMax = cornersXCoor.max()
+    if xMax <= 0:
+        return slice(0, 0), slice(0, 0)
+    sigma_z, sigma_y = dispersionCoef(xMax, stabilityClass)
+    halfWidth = np.sqrt(2*np.log(1/tolerance)) * sigma_y
+    #rectangle corners in relative domain coordinates
+    xDirection, yDirection = domain.windDirectionVectors[windDirection]
+    downwind = xMax/(1000*domainParams[0])
+    crosswind = halfWidth/(1000*domainParams[1])
+    rectXCoor = [sourceParams[0] + a*xDirection - b*yDirection for a in (0, downwind) for b in (-crosswind, crosswind)]
+    rectYCoor = [sourceParams[1] + a*yDirection + b*xDirection for a in (0, downwind) for b in (-crosswind, crosswind)]
+    #node [i,j] has relative coordinates x = j/(n-1), y = ((n-1)-i)/(n-1)
+    colStart = max(0, int(np.floor(min(rectXCoor)*(n-1))))
+    colStop = min(n, int(np.ceil(max(rectXCoor)*(n-1))) + 1)
+    rowStart = max(0, int(np.floor((1 - max(rectYCoor))*(n-1))))
+    rowStop = min(n, int(np.ceil((1 - min(rectYCoor))*(n-1))) + 1)
+    return slice(rowStart, max(rowStart, rowStop)), slice(colStart, max(colStart, colStop))
+
+def gaussDispEqDomain(sourceParams: list[float], zCoor: float, dispersionParams: list[float], domainParams: list[float], windDirection: str, stabilityClass: str, method: str = "vectorized", tolerance: float = 1e-6) -> NDArray[np.float64]:
     #Compute concetration values for whole domain, with given parameters (resolution)
+    #method: "vectorized" - transform whole node grid and evaluate gaussian plume equation for all nodes in one numpy pass
+    #        "sparse" - evaluate only nodes inside the plume wedge (see plumeRegion), other nodes are 0
+    #                   error of each node is lower than tolerance * plume centerline concentration at the same down-wind distance
+    #        "loop" - original node by node evaluation with scalar gaussDispEq (slow, kept as reference)
     #Return matrix - concentration field for the given domaian, given wind direction and stability class
     n = domainParams[2]
+    if method == "vectorized":
+        #get realative domain coord of all nodes and transform them into source coordinate system
+        x_point_domainCoor, y_point_domainCoor = domain.createDomainCoor(n)
+        point_xCoorSource, point_ySource = domain.domainToSourceCoor(x_point_domainCoor, y_point_domainCoor, sourceParams, domainParams, windDirection)
+        return gaussDispEqArray(point_xCoorSource, point_ySource, zCoor, sourceParams, dispersionParams, stabilityClass)
+    if method == "sparse":
+        partialConcField = domain.createDomainMatrix(n)
+        rows, cols = plumeRegion(sourceParams, dispersionParams, domainParams, windDirection, stabilityClass, tolerance)
+        x_point_domainCoor, y_point_domainCoor = domain.createDomainCoor(n)
+        point_xCoorSource, point_ySource = domain.domainToSourceCoor(x_point_domainCoor[rows,cols], y_point_domainCoor[rows,cols], sourceParams, domainParams, windDirection)
+        #nodes inside the wedge
+        sigma_z, sigma_y = dispersionCoef(np.where(point_xCoorSource > 0, point_xCoorSource, 1.0), stabilityClass)
+        inPlume = (point_xCoorSource > 0) & (point_ySource**2 <= 2*np.log(1/tolerance)*sigma_y**2)
+        partialConcField[rows,cols][inPlume] = gaussDispEqArray(point_xCoorSource[inPlume], point_ySource[inPlume], zCoor, sourceParams, dispersionParams, stabilityClass)
+        return partialConcField
+    if method != "loop":
+        raise ValueError("Unknown method: " + method)
     partialConcField = domain.createDomainMatrix(n) #create domain
     for i in range(n):
         for j in range(n):
@@ -90,6 +158,7 @@ def gaussDispEqDomain(sourceParams: list[float], zCoor: float, dispersionParams:
 
 def gaussDispEq_TotalConcField(sourceParams: list[float], dispersionParams: list[float], domainParams: list[float], stabilityClass: str) -> NDArray[np.float64]:
     #Compute cumulative concentration values for whole domain, for every wind direction and for specified stability class
+    checkWindRose(dispersionParams)
     n = domainParams[2]
     totalConcField = domain.createDomainMatrix(n) #create domain
     #Add concetration contribution for each wind direction
@@ -105,68 +174,544 @@ def gaussDispEq_TotalConcField(sourceParams: list[float], dispersionParams: list
     return totalConcField
 
 
+def gaussDispEqDomainAngle(sourceParams: list[float], zCoor: float, dispersionParams: list[float], domainParams: list[float], angle: float, stabilityClass: str) -> NDArray[np.float64]:
+    #Same as gaussDispEqDomain (vectorized), but for down-wind direction given by angle (see domain.windSectorAngles)
+    #Return matrix - concentration field for the given domain, wind direction and stability class
+    x_point_domainCoor, y_point_domainCoor = domain.createDomainCoor(domainParams[2])
+    point_xCoorSource, point_ySource = domain.domainToSourceCoorAngle(x_point_domainCoor, y_point_domainCoor, sourceParams, domainParams, angle)
+    return gaussDispEqArray(point_xCoorSource, point_ySource, zCoor, sourceParams, dispersionParams, stabilityClass)
+
+def gaussDispEqFieldAngle(sourceParams_all: list[list[float]], zCoor: float, dispersionParams: list[float], domainParams: list[float], angle: float, stabilityClass: str) -> NDArray[np.float64]:
+    #Compute total concentration field of all given sources for one wind direction given by angle (see domain.windSectorAngles),
+    #one stability class and atmospheric temperature and wind velocity dispersionParams[0:2] (e.g. one hour of meteorological time series)
+    #Sources are evaluated together using numpy broadcasting, in batches of at most ~4M nodes
+    n = domainParams[2]
+    x_point_domainCoor, y_point_domainCoor = domain.createDomainCoor(n)
+    totalConcField = domain.createDomainMatrix(n)
+    batchSize = max(1, 4000000//(n*n))
+    for batchStart in range(0, len(sourceParams_all), batchSize):
+        #each source parameter as column of shape (sourceCount, 1, 1), to broadcast against (i, j) node coordinates
+        sourceColumns = list(np.array(sourceParams_all[batchStart:batchStart+batchSize], dtype=np.float64).T[:,:,np.newaxis,np.newaxis])
+        point_xCoorSource, point_ySource = domain.domainToSourceCoorAngle(x_point_domainCoor, y_point_domainCoor, sourceColumns, domainParams, angle)
+        totalConcField += gaussDispEqArray(point_xCoorSource, point_ySource, zCoor, sourceColumns, dispersionParams, stabilityClass).sum(axis=0)
+    return totalConcField
+
+def plumeKernel(sourceParams: list[float], zCoor: float, dispersionParams: list[float], domainParams: list[float], stabilityClass: str, sectorCount: int = 8, oversample: int = 2, tailSigmas: float = 6.0, minRadius: float = 1.0) -> tuple[NDArray[np.float64], float, float]:
+    #Compute plume of the source once, on source-centered polar kernel grid (distance r, angle psi from down-wind direction)
+    #kernel[p,q] is concentration at distance r = minRadius*exp(p*radialStep) and angle psi = q*dTheta
+    #(angle is periodic, negative angles at the end)
+    #radial grid is geometric (relative spacing radialStep = 0.04/oversample), so that the plume is resolved close to the source
+    #(peak of low sources is often closer than one node spacing) as well as far from it, kernel reaches the farthest corner
+    #of the domain, angular spacing dTheta resolves the narrowest plume (sigma_y/x at the farthest corner) by 2*oversample samples
+    #and number of angles is multiple of sectorCount, so that sectors of the wind rose are whole shifts of the kernel
+    #plume is evaluated only inside wedge |psi| <= atan(tailSigmas*sigma_y/x), outside of it the kernel is 0
+    #Return kernel matrix, radialStep and dTheta in rad
+    reach = max(np.hypot(1000*domainParams[0]*(cornerX - sourceParams[0]), 1000*domainParams[1]*(cornerY - sourceParams[1])) for cornerX in (0, 1) for cornerY in (0, 1))
+    radialStep = 0.04/oversample
+    kernelRadius = minRadius*np.exp(np.arange(int(np.ceil(np.log(max(reach, minRadius)/minRadius)/radialStep)) + 2)*radialStep)
+    sigma_z, sigma_y = dispersionCoef(reach, stabilityClass)
+    #number of angles per sector is rounded up to fast FFT length
+    angleCount = sectorCount*scipy.fft.next_fast_len(int(np.ceil(2*np.pi*oversample*2*reach/sigma_y/sectorCount)))
+    dTheta = 2*np.pi/angleCount
+    #sigma_y/x is the largest close to the source (a/1000 from sigma_y_classCoef)
+    wedgeAngle = np.arctan(tailSigmas*sigma_y_classCoef[stabilityClass][0]/1000)
+    wedgeHalfWidth = min(int(np.ceil(wedgeAngle/dTheta)), (angleCount-1)//2)
+    wedgeIndex = np.arange(-wedgeHalfWidth, wedgeHalfWidth + 1)
+    kernel = np.zeros(shape = (len(kernelRadius), angleCount))
+    kernelAngle = wedgeIndex*dTheta
+    kernel[:, wedgeIndex % angleCount] = gaussDispEqArray(kernelRadius[:,np.newaxis]*np.cos(kernelAngle), kernelRadius[:,np.newaxis]*np.abs(np.sin(kernelAngle)), zCoor, sourceParams, dispersionParams, stabilityClass)
+    return kernel, radialStep, dTheta
+
+def gaussDispEq_TotalConcFieldRotated(sourceParams: list[float], dispersionParams: list[float], domainParams: list[float], stabilityClass: str, zCoor: float = 2, oversample: int = 2, rows: tuple[int, int] | None = None) -> NDArray[np.float64]:
+    #Compute cumulative concentration values for whole domain, for every sector of the wind rose and for specified stability class
+    #Wind rose can have any number of sectors - all values dispersionParams[2:] are shares of sectors (see domain.windSectorAngles)
+    #Plume is computed only once on polar grid around the source (plumeKernel). Sectors are shifts of the kernel in angle,
+    #so wind rose weighted kernel is circular convolution of the kernel with the wind rose along angle (computed by FFT),
+    #it is then resampled (bilinear interpolation in log(r) and angle) onto domain nodes only once,
+    #so runtime doesn't depend on the number of sectors.
+    #Distances and angles of nodes are taken in meters (isotropic also for domain with different x and y extent).
+    #If rows = (rowStart, rowStop) is given, only this block of rows of the domain is computed.
+    #Accuracy against direct evaluation can be checked by rotationKernelError (maximal node error ~0.3 % of maximal concentration
+    #for seed scenarios, all stability classes, 16 and 36 sectors and resolutions 15 - 200).
+    n = domainParams[2]
+    if rows is None:
+        rows = (0, n)
+    minRadius = 1.0
+    windRose = np.array(dispersionParams[2:], dtype=np.float64)
+    kernel, radialStep, dTheta = plumeKernel(sourceParams, zCoor, dispersionParams, domainParams, stabilityClass, len(windRose), oversample, minRadius=minRadius)
+    angleCount = kernel.shape[1]
+    #sector k turns the plume by k*2*pi/sectorCount from the first sector (domain.windSectorAngles)
+    sectorComb = np.zeros(angleCount)
+    sectorComb[np.arange(len(windRose))*(angleCount//len(windRose))] = windRose
+    roseKernel = np.fft.irfft(np.fft.rfft(kernel, axis=1)*np.fft.rfft(sectorComb), n=angleCount, axis=1)
+    #first angle repeated at the end, so that interpolation wraps around
+    roseKernel = np.concatenate([roseKernel, roseKernel[:,:1]], axis=1)
+    x_point_domainCoor, y_point_domainCoor = domain.createDomainCoor(n, rows[0], rows[1])
+    xDistance = 1000*domainParams[0]*(x_point_domainCoor - sourceParams[0])
+    yDistance = 1000*domainParams[1]*(y_point_domainCoor - sourceParams[1])
+    #nodes closer than minRadius get kernel value at minRadius
+    pointRadius = np.maximum(np.hypot(xDistance, yDistance), minRadius)
+    pointAngle = np.mod(np.arctan2(yDistance, xDistance) - domain.windSectorAngles(len(windRose))[0], 2*np.pi)
+    totalConcField = spimg.map_coordinates(roseKernel, [np.log(pointRadius/minRadius)/radialStep, pointAngle/dTheta], order=1, mode="nearest")
+    #FFT rounding errors can give tiny negative values
+    return np.maximum(totalConcField, 0)
+
+def rotationKernelError(sourceParams: list[float], dispersionParams: list[float], domainParams: list[float], stabilityClass: str, zCoor: float = 2, oversample: int = 2) -> dict:
+    #Measure accuracy of gaussDispEq_TotalConcFieldRotated against direct evaluation of each sector (gaussDispEqDomainAngle)
+    #Return dictionary with maximal node error (relative to maximal concentration), relative error of cumulative imission
+    #and run times of both methods
+    start = time.perf_counter()
+    rotatedField = gaussDispEq_TotalConcFieldRotated(sourceParams, dispersionParams, domainParams, stabilityClass, zCoor, oversample)
+    rotatedTime = time.perf_counter() - start
+    start = time.perf_counter()
+    windRose = dispersionParams[2:]
+    directField = domain.createDomainMatrix(domainParams[2])
+    for k, angle in enumerate(domain.windSectorAngles(len(windRose))):
+        directField += windRose[k]*gaussDispEqDomainAngle(sourceParams, zCoor, dispersionParams, domainParams, angle, stabilityClass)
+    directTime = time.perf_counter() - start
+    return {"sectorCount": len(windRose),
+            "maxError": float(np.abs(rotatedField - directField).max()/directField.max()),
+            "cumulativeError": float(abs(rotatedField.sum() - directField.sum())/directField.sum()),
+            "rotatedTime": rotatedTime,
+            "directTime": directTime}
+
+
 def totalConcFields_MainSmall(sourceParams_all: list[list[float]], dispersionParams: list[float], domainParams: list[float], stabilityClass: str ) -> tuple[NDArray[np.float64], NDArray[np.float64]]:
     #Compute cumulative concentration values for Central heat source and for combination of all distributed heat sources
     #(i.e. return two separate matrices - concentration fields)
-    totalConcField_MainSource = gaussDispEq_TotalConcField(sourceParams_all[0], dispersionParams, domainParams, stabilityClass)
-    totalConcField_SmallSources = gaussDispEq_TotalConcField(sourceParams_all[1], dispersionParams, domainParams, stabilityClass)
-    for indx in range(2,len(sourceParams_all)):
-        totalConcField_SmallSources += gaussDispEq_TotalConcField(sourceParams_all[indx], dispersionParams, domainParams, stabilityClass)
+    cumulativeImission, totalConcFields = computeFieldStack(sourceParams_all, dispersionParams, domainParams, [stabilityClass], returnFields=True)
+    totalConcField_MainSource = totalConcFields[0,0]
+    totalConcField_SmallSources = totalConcFields[0,1:].sum(axis=0)
     
     return totalConcField_MainSource, totalConcField_SmallSources
 
 
-def computeCumulativeImission(sourceParams: list[float], dispersionParams: list[float], domainParams: list[float], stabilityClass: str) -> float:
+def gaussDispEqStack(sourceParams_all: list[list[float]], zCoor: float, dispersionParams: list[float], domainParams: list[float], stabilityClass: str, tolerance: float | None = None, rows: tuple[int, int] | None = None) -> NDArray[np.float64]:
+    #Compute concentration fields for all given sources and all wind directions (domain.windDirections) at once,
+    #for specified stability class. Sources and wind directions are evaluated together using numpy broadcasting.
+    #If tolerance is given, each source and wind direction is evaluated only inside its plume wedge
+    #(gaussDispEqDomain with method "sparse"), which is faster for small sources with narrow plumes.
+    #If rows = (rowStart, rowStop) is given, only this block of rows of the domain is computed (tolerance is not used then)
+    #Return 4D array [source, wind direction, i, j] - concentration field for each source and each wind direction
+    n = domainParams[2]
+    if tolerance is not None and rows is None:
+        return np.array([[gaussDispEqDomain(sourceParams, zCoor, dispersionParams, domainParams, windDirection, stabilityClass, method="sparse", tolerance=tolerance)
+                          for windDirection in domain.windDirections] for sourceParams in sourceParams_all])
+    if rows is None:
+        #whole domain is computed in blocks of rows, so that temporaries of gaussDispEqArray stay small (see stackBatchNodes)
+        directionFields = np.empty(shape = (len(sourceParams_all), len(domain.windDirections), n, n))
+        tileRows = stackTileRows(n, len(sourceParams_all))
+        for rowStart in range(0, n, tileRows):
+            rowStop = min(n, rowStart + tileRows)
+            directionFields[:,:,rowStart:rowStop] = gaussDispEqStack(sourceParams_all, zCoor, dispersionParams, domainParams, stabilityClass, rows=(rowStart, rowStop))
+        return directionFields
+    x_point_domainCoor, y_point_domainCoor = domain.createDomainCoor(n, rows[0], rows[1])
+    #each source parameter as column of shape (sourceCount, 1, 1), to broadcast against (i, j) node coordinates
+    sourceColumns = list(np.array(sourceParams_all, dtype=np.float64).T[:,:,np.newaxis,np.newaxis])
+    point_xCoorSource = []
+    point_ySource = []
+    for windDirection in domain.windDirections:
+        xCoor, yCoor = domain.domainToSourceCoor(x_point_domainCoor, y_point_domainCoor, sourceColumns, domainParams, windDirection)
+        point_xCoorSource.append(xCoor)
+        point_ySource.append(yCoor)
+    #nodes coordinates of shape (sourceCount, directionCount, n, n) and source parameters of shape (sourceCount, 1, 1, 1)
+    point_xCoorSource = np.stack(point_xCoorSource, axis=1)
+    point_ySource = np.stack(point_ySource, axis=1)
+    sourceColumns = [column[:,np.newaxis] for column in sourceColumns]
+    return gaussDispEqArray(point_xCoorSource, point_ySource, zCoor, sourceColumns, dispersionParams, stabilityClass)
+
+
+def gaussDispEqReceptors(sourceParams_all: list[list[float]], dispersionParams: list[float], domainParams: list[float], stabilityClasses: list[str], receptors: NDArray[np.float64], perDirection: bool = False) -> NDArray[np.float64]:
+    #Compute concentrations only in receptor points instead of whole domain
+    #receptors: matrix [receptor, (x, y, height)] - relative domain coordinates and height above the terrain in m (see getinput.getReceptorData)
+    #All sources, stability classes and wind directions are evaluated in one batched call (broadcasting over sources, directions and receptors)
+    #Return array [stability class, source, receptor] of concentrations weighted by wind rose (as in gaussDispEq_TotalConcField),
+    #or [stability class, source, wind direction, receptor] of concentrations for each wind direction if perDirection is True
+    #Wind rose with other number of sectors than domain.windDirections is evaluated in down-wind directions of its sectors
+    #(domain.windSectorAngles), wind directions of perDirection output are then these sectors.
+    receptors = np.asarray(receptors, dtype=np.float64)
+    sourceCount = len(sourceParams_all)
+    if rotatedWindRose(dispersionParams):
+        sectorAngles = domain.windSectorAngles(len(dispersionParams) - 2)
+        directionCount = len(sectorAngles)
+    else:
+        directionCount = len(domain.windDirections)
+    receptorConc = np.zeros(shape = (len(stabilityClasses), sourceCount, directionCount, len(receptors)))
+    #sources evaluated together, so that one batch has at most ~4M points for all wind directions
+    batchSize = max(1, 4000000//(directionCount*max(1, len(receptors))))
+    for batchStart in range(0, sourceCount, batchSize):
+        #each source parameter as column of shape (sourceCount, 1), to broadcast against receptors
+        sourceColumns = list(np.array(sourceParams_all[batchStart:batchStart+batchSize], dtype=np.float64).T[:,:,np.newaxis])
+        point_xCoorSource = []
+        point_ySource = []
+        if rotatedWindRose(dispersionParams):
+            directionCoor = [domain.domainToSourceCoorAngle(receptors[:,0], receptors[:,1], sourceColumns, domainParams, angle) for angle in sectorAngles]
+        else:
+            directionCoor = [domain.domainToSourceCoor(receptors[:,0], receptors[:,1], sourceColumns, domainParams, windDirection) for windDirection in domain.windDirections]
+        for xCoor, yCoor in directionCoor:
+            point_xCoorSource.append(xCoor)
+            point_ySource.append(yCoor)
+        #receptor coordinates of shape (sourceCount, directionCount, receptorCount) and source parameters of shape (sourceCount, 1, 1)
+        point_xCoorSource = np.stack(point_xCoorSource, axis=1)
+        point_ySource = np.stack(point_ySource, axis=1)
+        batchColumns = [column[:,np.newaxis] for column in sourceColumns]
+        for i in range(len(stabilityClasses)):
+            receptorConc[i, batchStart:batchStart+len(sourceColumns[0])] = gaussDispEqArray(point_xCoorSource, point_ySource, receptors[:,2], batchColumns, dispersionParams, stabilityClasses[i])
+    if perDirection:
+        return receptorConc
+    #weight contribution of each wind direction with its percentage share
+    return np.tensordot(receptorConc, np.array(dispersionParams[2:]), axes=([2],[0]))
+
+
+def gaussDispEqStackCached(sourceParams_all: list[list[float]], zCoor: float, dispersionParams: list[float], domainParams: list[float], stabilityClass: str, cacheDir: str, tolerance: float | None = None) -> NDArray[np.float64]:
+    #Same as gaussDispEqStack, but fields at unit emission rate are taken from the persistent cache in cacheDir (see lib.fieldcache)
+    #Only fields of sources missing in the cache are computed (at unit emission) and stored in the cache,
+    #fields for actual emission rate sourceParams[6] are then obtained by scaling (concentration is linear in emission rate)
+    keys = [fieldcache.fieldKey(sourceParams, dispersionParams, domainParams, stabilityClass, zCoor, domain.windDirections, tolerance) for sourceParams in sourceParams_all]
+    unitFields = [fieldcache.loadFields(cacheDir, key) for key in keys]
+    missing = [indx for indx in range(len(keys)) if unitFields[indx] is None]
+    instrument.count("fieldCache.hits", len(keys) - len(missing))
+    instrument.count("fieldCache.misses", len(missing))
+    if missing:
+        unitSourceParams = [list(sourceParams_all[indx][0:6]) + [1.0] for indx in missing]
+        computedFields = gaussDispEqStack(unitSourceParams, zCoor, dispersionParams, domainParams, stabilityClass, tolerance)
+        for indx, fields in zip(missing, computedFields):
+            fieldcache.saveFields(cacheDir, keys[indx], fields)
+            unitFields[indx] = fields
+    emissionRates = np.array([sourceParams[6] for sourceParams in sourceParams_all], dtype=np.float64)
+    return emissionRates[:,np.newaxis,np.newaxis,np.newaxis] * np.stack(unitFields)
+
+
+#number of nodes (sources x wind directions x nodes of the domain) evaluated in one numpy pass of gaussDispEqArray
+#temporary arrays (~0.5 MB each) then stay in CPU cache - larger batches are slower than evaluation of single sources
+#(v01, 6 classes: n=200 6 sources 1.54 s, n=100 100 sources 6.39 s, against 2.20 s and 8.17 s for ~4M nodes)
+stackBatchNodes = 65536
+
+
+def stackBatchSize(n: int) -> int:
+    #number of sources evaluated together by gaussDispEqStack, so that one batch has at most stackBatchNodes nodes
+    #for all wind directions (at least one source, its domain is then split into blocks of rows, see stackTileRows)
+    return max(1, stackBatchNodes//(len(domain.windDirections)*n*n))
+
+
+def stackTileRows(n: int, sourceCount: int) -> int:
+    #number of rows of the domain evaluated together for sourceCount sources, so that one block has at most stackBatchNodes nodes
+    return max(1, stackBatchNodes//(len(domain.windDirections)*n*sourceCount))
+
+
+def rotatedWindRose(dispersionParams: list[float]) -> bool:
+    #Return True if wind rose dispersionParams[2:] has other number of sectors than domain.windDirections
+    #(e.g. 16 or 36 sectors) - such wind rose is evaluated by gaussDispEq_TotalConcFieldRotated
+    return len(dispersionParams) != 2 + len(domain.windDirections)
+
+
+def checkWindRose(dispersionParams: list[float]) -> None:
+    #Check that wind rose dispersionParams[2:] has one share for each wind direction of domain.windDirections
+    #(needed by functions working with fields of single wind directions, finer wind roses are handled by totalConcFieldBatch)
+    if rotatedWindRose(dispersionParams):
+        raise ValueError("Wind rose has " + str(len(dispersionParams) - 2) + " sectors, " + str(len(domain.windDirections))
+                         + " are required (finer wind roses are supported by computeFieldStack and streamImissionStats)")
+
+
+def windRoseField(directionFields: NDArray[np.float64], dispersionParams: list[float]) -> NDArray[np.float64]:
+    #Weight contribution of each wind direction with its percentage share (dispersionParams[2:10])
+    #directionFields is array [..., wind direction, i, j] (e.g. from gaussDispEqStack)
+    #Return total concentration fields [..., i, j]
+    checkWindRose(dispersionParams)
+    totalConcField = np.zeros(shape = directionFields.shape[:-3] + directionFields.shape[-2:])
+    for k in range(len(domain.windDirections)):
+        totalConcField += dispersionParams[2+k]*directionFields[...,k,:,:]
+    return totalConcField
+
+
+def totalConcFieldBatch(sourceParams_batch: list[list[float]], zCoor: float, dispersionParams: list[float], domainParams: list[float], stabilityClass: str, cacheDir: str | None = None, tolerance: float | None = None, rows: tuple[int, int] | None = None) -> NDArray[np.float64]:
+    #Compute total concentration fields (weighted by wind rose) for a batch of sources and one stability class
+    #Wind rose with other number of sectors than domain.windDirections (see rotatedWindRose) is evaluated
+    #by gaussDispEq_TotalConcFieldRotated for each source (cacheDir and tolerance are not used then)
+    #If rows = (rowStart, rowStop) is given, only this block of rows of the domain is returned
+    #Return array [source, i, j]
+    n = domainParams[2]
+    if rows is None:
+        rows = (0, n)
+    if rotatedWindRose(dispersionParams):
+        return np.stack([gaussDispEq_TotalConcFieldRotated(sourceParams, dispersionParams, domainParams, stabilityClass, zCoor, rows=rows) for sourceParams in sourceParams_batch])
+    if cacheDir is None and tolerance is None:
+        #fields of all wind directions are weighted block by block of rows, without materializing them for whole domain
+        totalConcField = np.empty(shape = (len(sourceParams_batch), rows[1]-rows[0], n))
+        tileRows = stackTileRows(n, len(sourceParams_batch))
+        for rowStart in range(rows[0], rows[1], tileRows):
+            rowStop = min(rows[1], rowStart + tileRows)
+            totalConcField[:, rowStart-rows[0]:rowStop-rows[0]] = windRoseField(gaussDispEqStack(sourceParams_batch, zCoor, dispersionParams, domainParams, stabilityClass, rows=(rowStart, rowStop)), dispersionParams)
+        return totalConcField
+    if cacheDir is None:
+        directionFields = gaussDispEqStack(sourceParams_batch, zCoor, dispersionParams, domainParams, stabilityClass, tolerance)
+    else:
+        directionFields = gaussDispEqStackCached(sourceParams_batch, zCoor, dispersionParams, domainParams, stabilityClass, cacheDir, tolerance)
+    return windRoseField(directionFields[..., rows[0]:rows[1], :], dispersionParams)
+
+
+def computeFieldStack(sourceParams_all: list[list[float]], dispersionParams: list[float], domainParams: list[float], stabilityClasses: list[str], zCoor: float = 2, returnFields: bool = False, cacheDir: str | None = None, cacheMaxBytes: int = 2*1024**3, tolerance: float | None = None, fieldClasses: list[str] | None = None):
+    #Compute concentration fields of all sources, for all stability classes and all wind directions in batched calls
+    #(sources and blocks of rows are evaluated in batches of stackBatchNodes nodes, which stay in CPU cache)
+    #Return cumulativeImission matrix [stability class, source] - summ of concentrations through whole domain,
+    #as computeCumulativeImission returns for every pair of stability class and source.
+    #If returnFields is True, return also the field stack [stability class, source, i, j], where each field is
+    #total concentration field weighted by wind rose (as returned by gaussDispEq_TotalConcField)
+    #fieldClasses: stability classes (from stabilityClasses) of the returned field stack [field class, source, i, j],
+    #              None = all stabilityClasses (field stack of all classes can be large, e.g. only class of output fields is needed)
+    #If cacheDir is given, fields at unit emission are reused from (and stored to) persistent cache in cacheDir,
+    #so change of emission rates or wind rose shares needs no recomputation of fields.
+    #Least recently used cached fields are deleted when the cache grows over cacheMaxBytes.
+    #If tolerance is given, only nodes inside plume wedge of each source are evaluated (see plumeRegion).
+    #Wind rose can have also other number of sectors than domain.windDirections (e.g. 16 or 36), fields are then computed
+    #by gaussDispEq_TotalConcFieldRotated (see totalConcFieldBatch, cacheDir and tolerance are not used).
+    n = domainParams[2]
+    sourceCount = len(sourceParams_all)
+    batchSize = stackBatchSize(n)
+    cumulativeImission = np.zeros(shape = (len(stabilityClasses), sourceCount))
+    if fieldClasses is None:
+        fieldClasses = stabilityClasses
+    if returnFields:
+        totalConcFields = np.zeros(shape = (len(fieldClasses), sourceCount, n, n))
+    for i in range(len(stabilityClasses)):
+        for batchStart in range(0, sourceCount, batchSize):
+            batch = sourceParams_all[batchStart:batchStart+batchSize]
+            with instrument.span("totalConcFieldBatch", stabilityClass=stabilityClasses[i], sources=[batchStart, batchStart+len(batch)], resolution=n):
+                totalConcField = totalConcFieldBatch(batch, zCoor, dispersionParams, domainParams, stabilityClasses[i], cacheDir, tolerance)
+            cumulativeImission[i, batchStart:batchStart+len(batch)] = totalConcField.sum(axis=(1,2))
+            if returnFields and stabilityClasses[i] in fieldClasses:
+                totalConcFields[fieldClasses.index(stabilityClasses[i]), batchStart:batchStart+len(batch)] = totalConcField
+    if cacheDir is not None:
+        with instrument.span("fieldCache.evict"):
+            fieldcache.evict(cacheDir, cacheMaxBytes)
+    if returnFields:
+        return cumulativeImission, totalConcFields
+    return cumulativeImission
+
+
+def streamImissionStats(sourceParams_all: list[list[float]], dispersionParams: list[float], domainParams: list[float], stabilityClass: str, sourceWeights: NDArray[np.float64] | None = None, imissionLimit: float | None = None, outputFiles: list[str] | None = None, tileRows: int | None = None, zCoor: float = 2, returnFields: bool = False) -> dict:
+    #Streaming computation of imission statistics for specified stability class, without materializing whole fields in memory
+    #Domain is computed in blocks of tileRows rows (all sources, all wind directions), each block is reduced into running totals
+    #and released, so peak memory is bounded by the block size, not by the domain size.
+    #sourceWeights: matrix [output field, source] - each output field is combination of total concentration fields of sources
+    #               (e.g. optimal power outputs), default is one output field with all sources at nominal power
+    #imissionLimit: if given, number of nodes with concentration higher than the limit is counted for each output field
+    #outputFiles: if given, output fields are written block by block to these .npy files (memory-mapped, one file for each output field)
+    #returnFields: if True (and outputFiles are not given), output fields are kept in memory and returned in "fields"
+    #              (only the output fields, not fields of all sources)
+    #Return dictionary with:
+    #  "cumulativeImission" - summ of concentrations through whole domain for each source (as computeCumulativeImission)
+    #  "fieldCumulative", "fieldMax", "exceedances" - summ, maximum and count of nodes over the limit for each output field
+    #  "fields" - memory-mapped output fields (if outputFiles are given) or output fields in memory (if returnFields is True)
+    #Wind rose with other number of sectors than domain.windDirections is evaluated by gaussDispEq_TotalConcFieldRotated,
+    #its polar kernel is computed for each block of rows, so the default block is then whole domain.
+    n = domainParams[2]
+    sourceCount = len(sourceParams_all)
+    if sourceWeights is None:
+        sourceWeights = np.ones(shape = (1, sourceCount))
+    sourceWeights = np.asarray(sourceWeights, dtype=np.float64)
+    fieldCount = sourceWeights.shape[0]
+    #sources evaluated together in one block and default block size, so that one block has at most stackBatchNodes nodes
+    #for all wind directions
+    batchSize = min(sourceCount, stackBatchSize(n))
+    if tileRows is None:
+        tileRows = n if rotatedWindRose(dispersionParams) else stackTileRows(n, batchSize)
+
+    cumulativeImission = np.zeros(sourceCount)
+    fieldCumulative = np.zeros(fieldCount)
+    fieldMax = np.zeros(fieldCount)
+    exceedances = np.zeros(fieldCount, dtype=np.int64)
+    fields = None
+    if outputFiles is not None:
+        fields = [np.lib.format.open_memmap(fileName, mode="w+", dtype=np.float64, shape=(n,n)) for fileName in outputFiles]
+    elif returnFields:
+        fields = [np.zeros(shape = (n,n)) for _ in range(fieldCount)]
+    for rowStart in range(0, n, tileRows):
+        rowStop = min(n, rowStart + tileRows)
+        tileFields = np.zeros(shape = (fieldCount, rowStop-rowStart, n))
+        for batchStart in range(0, sourceCount, batchSize):
+            batch = sourceParams_all[batchStart:batchStart+batchSize]
+            with instrument.span("streamTileBatch", stabilityClass=stabilityClass, sources=[batchStart, batchStart+len(batch)], rows=[rowStart, rowStop]):
+                totalConcField = totalConcFieldBatch(batch, zCoor, dispersionParams, domainParams, stabilityClass, rows=(rowStart, rowStop))
+            cumulativeImission[batchStart:batchStart+len(batch)] += totalConcField.sum(axis=(1,2))
+            tileFields += np.tensordot(sourceWeights[:, batchStart:batchStart+len(batch)], totalConcField, axes=1)
+        fieldCumulative += tileFields.sum(axis=(1,2))
+        fieldMax = np.maximum(fieldMax, tileFields.max(axis=(1,2)))
+        if imissionLimit is not None:
+            exceedances += (tileFields > imissionLimit).sum(axis=(1,2))
+        if fields is not None:
+            for indx in range(fieldCount):
+                fields[indx][rowStart:rowStop] = tileFields[indx]
+    if outputFiles is not None:
+        for field in fields:
+            field.flush()
+    return {"cumulativeImission": cumulativeImission,
+            "fieldCumulative": fieldCumulative,
+            "fieldMax": fieldMax,
+            "exceedances": exceedances if imissionLimit is not None else None,
+            "fields": fields}
+
+
+def computeCumulativeImission(sourceParams: list[float], dispersionParams: list[float], domainParams: list[float], stabilityClass: str, tileRows: int | None = None) -> float:
     #Compute cumulative imission concentration (through whole domain) for givenh stability class and for given source (at nominal power) 
     #Cumulative imission means summ of all computed concentrationf for each point in the domain. 
     #Represent the overal imission polution of computed domain.
+    #Domain is computed and summed in blocks of tileRows rows (see streamImissionStats), so whole field is never stored in memory
     # Return cumulative imission as one value, which represents given source and stability class.
-    n = domainParams[2]
-    concField = gaussDispEq_TotalConcField(sourceParams, dispersionParams, domainParams, stabilityClass)
-    imissionCum = 0
-    for i in range(n):
-        for j in range(n):
-            imissionCum += concField[i,j] #TO DO, solve case when actual concentration is higher than imission limit
-    return imissionCum
+    #concentration limit in each node of the domain is solved by minimizeImissionsLimited
+    return streamImissionStats([sourceParams], dispersionParams, domainParams, stabilityClass, tileRows=tileRows)["cumulativeImission"][0]
+
+
+def powerShareCoef(sourceParams_all: list[list[float]]) -> list[float]:
+    #Return coefficients of total power constraint - nominal power of each source relative to required total power
+    #(power output and emission rate are considered equivalent, required total power is nominal power of the main (first) source)
+    return [sourceParams[6]/sourceParams_all[0][6] for sourceParams in sourceParams_all]
+
 
-def minimizeImissions(imissionCums: NDArray[np.float64]) -> list[float]:
+def minimizeImissions(imissionCums: NDArray[np.float64], powerShares: list[float] | None = None, method: str = "linprog", fullOutput: bool = False):
     #Minimalization of total cumulative imissions for all sources and every stability class, with respect to power output of each source
     #Key constraint is, that combined power output of all sources must be constant (in order to supply necessary amount of heat)
+    #imissionCums: matrix [stability class, source] of cumulative imissions
+    #powerShares: nominal power of each source relative to required total power (e.g. from powerShareCoef),
+    #             if None, main source (first) covers whole required power and each other source 0.2 of it
+    #method: "linprog" - cumulative imissions are non-negative, so L1 norm of imissionCums@x is linear in x
+    #                    and problem is solved as linear program (HiGHS solver)
+    #        "trust-constr" - original nonlinear formulation solved by trust-constr method (slow, kept as fallback)
+    #Return vector of optimal power outputs (relative to nominal power, from <0,1>) of all sources,
+    #if fullOutput is True return also dictionary with solver information (solve time, objective, iterations)
+    #Raise ValueError if linear program has no solution (e.g. required power can't be covered with given powerShares)
     '''
     There are still some (probably major) problems. Change in resolution of the domain, without any changes in other parameters
     causes changes in optimized solution.  Solution however appears to converge with the higher resolution.
     '''
-    #dimension xinit must  be changed when the number of sources is changed.
-    #in automated version, number of elements and their values should be initiated according to number of sources and constraints on x
-    #CHANGE OF SOURCE COUNT: change dimension of xinit according to source count
-    lst = [0.4, 0.6, 0.6, 0.6, 0.6, 0.6]
-    #lst = [0.5, 0.5, 0.5]
-    xinit = np.array(lst)
-
-    minimizingFunction = lambda x: (np.linalg.norm((imissionCums@x), ord=1))
-
-    #Constraints
-    #TO DO: need to rewrite for automatic idettification of number of sources and corresponding number of constraints
-    #CHANGE OF SOURCE COUNT: delete or add constraints for each element in optimized x (one element for each source)
-    con0 = lambda x: x[0]
-    cons0 = spopt.NonlinearConstraint(con0, 0, 1)
-    con1 = lambda x: x[1]
-    cons1 = spopt.NonlinearConstraint(con1, 0, 1)
-    con2 = lambda x: x[2]
-    cons2 = spopt.NonlinearConstraint(con2, 0, 1)
-    con3 = lambda x: x[3]
-    cons3 = spopt.NonlinearConstraint(con3, 0, 1)
-    con4 = lambda x: x[4]
-    cons4 = spopt.NonlinearConstraint(con4, 0, 1)
-    con5 = lambda x: x[5]
-    cons5 = spopt.NonlinearConstraint(con5, 0, 1)
-    conNonLin = lambda x: 1*x[0]+0.2*x[1]+0.2*x[2]+0.2*x[3]+0.2*x[4]+0.2*x[5]
-    #conNonLin = lambda x: 1*x[0]+0.5*x[1]+0.5*x[2]
-    consNonLin = spopt.NonlinearConstraint(conNonLin, 1, 1)
-    #CHANGE OF SOURCE COUNT: delete or add constraints
-    cons =[cons0, cons1, cons2, cons3, cons4, cons5, consNonLin]
-
-    #optimize vector of optimal power outputs for all sources, with respect to minimal cumulative imissions in the domain
-    res = spopt.minimize(minimizingFunction, x0=xinit, constraints=cons, method = "trust-constr")
-
-    return res.x
+    sourceCount = imissionCums.shape[1]
+    if powerShares is None:
+        powerShares = [1.0] + [0.2]*(sourceCount-1)
+
+    start = time.perf_counter()
+    if method == "linprog":
+        #objective: summ of cumulative imissions through all stability classes, for each source
+        #constraints: 0 <= x <= 1 for each source and combined power output powerShares@x = 1
+        res = spopt.linprog(imissionCums.sum(axis=0), A_eq=np.array([powerShares]), b_eq=np.array([1.0]), bounds=(0, 1), method="highs")
+        if not res.success:
+            raise ValueError("Optimization failed: " + str(res.message))
+        x = res.x
+        iterations = res.nit
+    elif method == "trust-constr":
+        xinit = np.array([0.4] + [0.6]*(sourceCount-1))
+        minimizingFunction = lambda x: (np.linalg.norm((imissionCums@x), ord=1))
+        #Constraints - power output of each source from <0,1> and combined power output of all sources
+        cons = [spopt.NonlinearConstraint(lambda x, indx=indx: x[indx], 0, 1) for indx in range(sourceCount)]
+        conNonLin = lambda x: sum(powerShares[indx]*x[indx] for indx in range(sourceCount))
+        cons.append(spopt.NonlinearConstraint(conNonLin, 1, 1))
+        #optimize vector of optimal power outputs for all sources, with respect to minimal cumulative imissions in the domain
+        res = spopt.minimize(minimizingFunction, x0=xinit, constraints=cons, method = "trust-constr")
+        x = res.x
+        iterations = res.nit
+    else:
+        raise ValueError("Unknown method: " + method)
+    solveTime = time.perf_counter() - start
+    instrument.count("minimizeImissions.calls")
+    instrument.count("minimizeImissions.iterations", int(iterations))
+    instrument.count("minimizeImissions.solveTime", solveTime)
+
+    if fullOutput:
+        info = {"method": method, "solveTime": solveTime, "objective": float(np.linalg.norm(imissionCums@x, ord=1)),
+                "iterations": int(iterations), "success": bool(res.success), "message": str(res.message)}
+        return x, info
+    return x
+
+
+def minimizeImissionsLimited(imissionCums: NDArray[np.float64], fields: NDArray[np.float64], imissionLimit: float, powerShares: list[float] | None = None, margin: float = 0.1, maxAddNodes: int = 10000, maxIter: int = 100):
+    #Minimalization of total cumulative imissions (as minimizeImissions with method "linprog"), with additional constraint,
+    #that concentration in every node of the domain is not higher than imissionLimit for each stability class
+    #fields: field stack [stability class, source, i, j] at nominal power (e.g. from computeFieldStack with returnFields=True),
+    #        concentration in node for power outputs x is fields[class, :, i, j]@x, so fields are the constraint matrix
+    #Node constraints are added lazily - linear program is solved with current set of active nodes, then nodes with concentration
+    #higher than imissionLimit*(1 - margin) are added (at most maxAddNodes nodes with the highest concentration in one iteration),
+    #until no node exceeds the limit. Nodes which can't exceed the limit even with all sources at nominal power are never checked.
+    #Return vector of optimal power outputs and dictionary with solver information (solve time, objective, iterations,
+    #number of active nodes, binding nodes [stability class, i, j] - nodes with concentration at the limit)
+    #Raise ValueError if the limit can't be met by any power combination (or is still exceeded after maxIter iterations)
+    sourceCount = imissionCums.shape[1]
+    if powerShares is None:
+        powerShares = [1.0] + [0.2]*(sourceCount-1)
+
+    start = time.perf_counter()
+    fieldShape = (fields.shape[0],) + fields.shape[2:]
+    #candidate nodes (flat index of [stability class, i, j]) - concentration with all sources at nominal power is over the limit
+    candidates = np.flatnonzero(fields.sum(axis=1) > imissionLimit)
+    #constraint matrix rows of candidate nodes [node, source], indexed directly in the field stack (without copy of the whole stack)
+    candidateClass, candidateI, candidateJ = np.unravel_index(candidates, fieldShape)
+    candidateRows = fields[candidateClass, :, candidateI, candidateJ]
+    #objective relative to its largest coefficient (all-zero objective is used as it is)
+    objective = imissionCums.sum(axis=0)
+    if objective.max() > 0:
+        objective = objective/objective.max()
+    active = np.zeros(len(candidates), dtype=bool)
+    iterations = 0
+    solverIterations = 0
+    while True:
+        iterations += 1
+        #node constraints relative to the limit (concentrations are ~1e-6 g.m-3, below absolute tolerance of the solver)
+        A_ub = candidateRows[active]/imissionLimit if active.any() else None
+        b_ub = np.ones(int(active.sum())) if active.any() else None
+        res = spopt.linprog(objective, A_ub=A_ub, b_ub=b_ub, A_eq=np.array([powerShares]), b_eq=np.array([1.0]), bounds=(0, 1), method="highs")
+        if not res.success:
+            raise ValueError("Imission limit can't be met: " + str(res.message))
+        x = res.x
+        solverIterations += res.nit
+        candidateConc = candidateRows@x
+        violated = candidateConc > imissionLimit*(1 + 1e-9)
+        if not violated.any():
+            break
+        if iterations >= maxIter:
+            raise ValueError("Imission limit is still exceeded in " + str(int(violated.sum())) + " nodes after " + str(maxIter) + " iterations")
+        #add violated nodes and nodes near the limit, with the highest concentration first
+        newNodes = np.flatnonzero(~active & (candidateConc > imissionLimit*(1 - margin)))
+        newNodes = newNodes[np.argsort(-candidateConc[newNodes])[:maxAddNodes]]
+        active[newNodes] = True
+    solveTime = time.perf_counter() - start
+    instrument.count("minimizeImissionsLimited.iterations", iterations)
+    instrument.count("minimizeImissionsLimited.solverIterations", int(solverIterations))
+    instrument.count("minimizeImissionsLimited.activeNodes", int(active.sum()))
+
+    binding = np.flatnonzero(active)[candidateConc[active] >= imissionLimit*(1 - 1e-6)]
+    info = {"method": "linprog-limited", "solveTime": solveTime, "objective": float(np.linalg.norm(imissionCums@x, ord=1)),
+            "iterations": iterations, "solverIterations": int(solverIterations), "candidateNodes": len(candidates),
+            "activeNodes": int(active.sum()), "bindingNodes": np.array(np.unravel_index(candidates[binding], fieldShape)).T,
+            "maxConcentration": float(np.tensordot(fields, x, axes=([1],[0])).max()),
+            "success": bool(res.success), "message": str(res.message)}
+    return x, info
+
+
+def minimizeImissionsAdaptive(sourceParams_all: list[list[float]], dispersionParams: list[float], domainParams: list[float], stabilityClasses: list[str], shareTolerance: float = 1e-3, startResolution: int = 25, maxResolution: int = 801, refineFactor: int = 2, powerShares: list[float] | None = None, method: str = "linprog", cacheDir: str | None = None, plumeTolerance: float | None = None):
+    #Optimal power outputs with resolution-adaptive computation of cumulative imissions
+    #(optimized solution changes with resolution of the domain and converges with the higher resolution, see minimizeImissions)
+    #Cumulative imission matrix is computed and optimized at increasing resolutions startResolution, (startResolution-1)*refineFactor+1, ...
+    #(refined grid contains all nodes of the previous one, the last resolution is maxResolution) until optimal power outputs
+    #of all sources change by less than shareTolerance between two successive resolutions, or maxResolution is reached.
+    #Return vector of optimal power outputs (at the finest computed resolution) and dictionary with reached resolution,
+    #information whether the solution converged, total time and history of resolutions, solutions and times
+    start = time.perf_counter()
+    history = []
+    x = None
+    converged = False
+    n = startResolution
+    while True:
+        stepStart = time.perf_counter()
+        domainParams_n = list(domainParams[0:2]) + [n] + list(domainParams[3:])
+        with instrument.span("adaptiveResolution", resolution=n):
+            cumulativeImission = computeFieldStack(sourceParams_all, dispersionParams, domainParams_n, stabilityClasses, cacheDir=cacheDir, tolerance=plumeTolerance)
+            previousX = x
+            x = minimizeImissions(cumulativeImission, powerShares, method=method)
+        history.append({"resolution": n, "powerOutputs": x, "time": time.perf_counter() - stepStart})
+        if previousX is not None and np.max(np.abs(x - previousX)) < shareTolerance:
+            converged = True
+            break
+        if n >= maxResolution:
+            break
+        #last refinement is clamped to maxResolution
+        n = min((n - 1)*refineFactor + 1, maxResolution)
+    info = {"resolution": n, "converged": converged, "totalTime": time.perf_counter() - start, "history": history}
+    return x, info
@@ -1,3 +1,15 @@
+import os
+import re
+import csv
+import glob
+import itertools
+import numpy as np
+import numpy.lib.recfunctions as rfn
+from numpy.typing import NDArray
+
+
+#names of columns of source table (sources.csv, sources.npz), in the order of elements of sourceParams (see getSourceData)
+sourceFields = ["x", "y", "height", "diameter", "velocity", "temperature", "emission"]
 
 
 def getInputData(domainFile: str, dispersionFile: str) -> tuple[list[float], list[float]]:
@@ -29,6 +41,8 @@ def getInputData(domainFile: str, dispersionFile: str) -> tuple[list[float], lis
     #atmospheric temperature [°K] (format: double)
     #average wind velocity [m/s] (format:double)
     #wind rose on next 8 lines- percentage share of wind directions per year (format:double)
+    #finer wind rose (e.g. 16 or 36 sectors) can follow on the next lines, in the order of domain.windSectorAngles
+    #(such wind rose is evaluated by ge.gaussDispEq_TotalConcFieldRotated, see ge.totalConcFieldBatch, sweeps need 8 sectors)
     dispersionParams = []
     f = open(dispersionFile, "r")
     #get atmospheric temperature
@@ -61,6 +75,10 @@ def getInputData(domainFile: str, dispersionFile: str) -> tuple[list[float], lis
     #get percentage share of wind from NW direction
     NW_wind = f.readline()
     dispersionParams.append(float(NW_wind))
+    #get percentage shares of remaining sectors of finer wind rose (if present)
+    for line in f:
+        if line.strip():
+            dispersionParams.append(float(line))
 
     f.close()
     
@@ -105,4 +123,113 @@ def getSourceData(sourceFile: str) -> list[float]:
 
     f.close()
 
-    return sourceParams
\ No newline at end of file
+    return sourceParams
+
+
+def getMeteoSeries(meteoFile: str, chunkSize: int = 744, startRecord: int = 0, stopRecord: int | None = None):
+    #Read hourly meteorological time series in chunks (generator, whole file is never loaded into memory)
+    #Input file name: e.g. meteo.csv
+    #csv file with header line and one line for each hour (lines starting with # are comments):
+    #windDirection,windSpeed,temperature,stabilityClass
+    #windDirection: meteorological wind direction - direction the wind blows from, in degrees (0 = N, 90 = E, 180 = S, 270 = W)
+    #               or one of the strings "N", "NE", "E", ... (e.g. "N" is wind blowing from north to south, while wind rose
+    #               in dispersion.txt gives shares of down-wind directions)
+    #windSpeed: average wind velocity [m/s] (format: double)
+    #temperature: atmospheric temperature [°K] (format: double)
+    #stabilityClass: stability class of the atmosphere ("A" - "F")
+    #Only records startRecord, ..., stopRecord-1 are read (e.g. one month of the year)
+    #Yield lists of at most chunkSize records, each record is tuple (windDirection [degrees, from], windSpeed, temperature, stabilityClass)
+    compassDegrees = {"N": 0.0, "NE": 45.0, "E": 90.0, "SE": 135.0, "S": 180.0, "SW": 225.0, "W": 270.0, "NW": 315.0}
+    with open(meteoFile, "r", newline="") as f:
+        records = csv.DictReader(line for line in f if line.strip() and not line.startswith("#"))
+        records = itertools.islice(records, startRecord, stopRecord)
+        while True:
+            chunk = []
+            for row in itertools.islice(records, chunkSize):
+                windDirection = row["windDirection"].strip()
+                if windDirection in compassDegrees:
+                    windDirection = compassDegrees[windDirection]
+                chunk.append((float(windDirection), float(row["windSpeed"]), float(row["temperature"]), row["stabilityClass"].strip()))
+            if not chunk:
+                break
+            yield chunk
+
+
+def getReceptorData(receptorFile: str) -> tuple[NDArray[np.float64], list[str]]:
+    #Get receptor points (e.g. schools, hospitals, monitoring stations), where concentrations are computed
+    #Input file name: e.g. receptors.csv
+    #csv file with header line and one line for each receptor (lines starting with # are comments):
+    #x,y,height[,name]
+    #x, y: relative coordinates of receptor in domain (numbers from <0,1> interval, as coordinates of sources)
+    #height: height of receptor above the terrain [m] (format: double)
+    #name: optional name of receptor
+    #Return matrix of receptors [receptor, (x, y, height)] and list of receptor names
+    receptors = []
+    names = []
+    with open(receptorFile, "r", newline="") as f:
+        for row in csv.DictReader(line for line in f if line.strip() and not line.startswith("#")):
+            receptors.append([float(row["x"]), float(row["y"]), float(row["height"])])
+            names.append(row.get("name", "receptor " + str(len(names)+1)).strip())
+    return np.array(receptors, dtype=np.float64).reshape(-1, 3), names
+
+
+def discoverSourceFiles(scenarioFolder: str) -> list[str]:
+    #Find all source files in scenario folder: sourceMain.txt (first, if present) and all sourceDistributed_XX.txt files,
+    #ordered by their number
+    sourceFiles = []
+    if os.path.exists(os.path.join(scenarioFolder, "sourceMain.txt")):
+        sourceFiles.append(os.path.join(scenarioFolder, "sourceMain.txt"))
+    distributedFiles = glob.glob(os.path.join(scenarioFolder, "sourceDistributed_*.txt"))
+    distributedFiles.sort(key=lambda fileName: [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", os.path.basename(fileName))])
+    return sourceFiles + distributedFiles
+
+
+def getSourceTable(sourceTableFile: str) -> NDArray:
+    #Get parameters of all sources from one columnar file (one row for each source, main source first)
+    #Input file name: sources.csv or sources.npz
+    #sources.csv: csv file with header line x,y,height,diameter,velocity,temperature,emission (columns as in getSourceData)
+    #sources.npz: numpy file with structured array "sources" with the same fields
+    #Return structured array with fields sourceFields
+    if sourceTableFile.endswith(".npz"):
+        with np.load(sourceTableFile) as data:
+            return data["sources"]
+    return np.atleast_1d(np.genfromtxt(sourceTableFile, delimiter=",", names=True, dtype=np.float64, comments="#"))
+
+
+def writeSourceTable(sourceParams_all: list[list[float]], sourceTableFile: str) -> None:
+    #Write parameters of all sources into one columnar file (sources.csv or sources.npz, see getSourceTable)
+    #(e.g. to convert scenario with many sourceDistributed_XX.txt files into compact format)
+    sourceArray = np.array(sourceParams_all, dtype=np.float64).reshape(-1, len(sourceFields))
+    if sourceTableFile.endswith(".npz"):
+        np.savez(sourceTableFile, sources=rfn.unstructured_to_structured(sourceArray, names=sourceFields))
+    else:
+        np.savetxt(sourceTableFile, sourceArray, delimiter=",", header=",".join(sourceFields), comments="", fmt="%.17g")
+
+
+def getScenarioSources(scenarioFolder: str) -> list[list[float]]:
+    #Get parameters of all sources of the scenario
+    #from sources.npz or sources.csv (if present in scenario folder), otherwise from all source text files (see discoverSourceFiles)
+    #Return list of sourceParams (as getSourceData returns), main source first
+    for sourceTableFile in ["sources.npz", "sources.csv"]:
+        if os.path.exists(os.path.join(scenarioFolder, sourceTableFile)):
+            sourceTable = getSourceTable(os.path.join(scenarioFolder, sourceTableFile))
+            return rfn.structured_to_unstructured(sourceTable[sourceFields], dtype=np.float64).tolist()
+    return [getSourceData(sourceFile) for sourceFile in discoverSourceFiles(scenarioFolder)]
+
+
+def getScenario(scenarioFolder: str) -> tuple[list[float], list[float], list[list[float]]]:
+    #Get all input data of the scenario folder (domain.txt, dispersion.txt and all sources)
+    #Return domainParams, dispersionParams and list of sourceParams of all sources
+    domainParams, dispersionParams = getInputData(os.path.join(scenarioFolder, "domain.txt"), os.path.join(scenarioFolder, "dispersion.txt"))
+    return domainParams, dispersionParams, getScenarioSources(scenarioFolder)
+
+
+def discoverScenarios(inputFolder: str) -> list[str]:
+    #Find all scenario folders (folders with domain.txt) in input folder, e.g. ./input/v01/, ./input/v02/
+    return sorted(os.path.dirname(fileName) + os.sep for fileName in glob.glob(os.path.join(inputFolder, "*", "domain.txt")))
+
+
+def getScenarios(scenarioFolders: list[str]) -> dict[str, tuple[list[float], list[float], list[list[float]]]]:
+    #Get input data of many scenario folders at once (see getScenario)
+    #Return dictionary {scenario folder: (domainParams, dispersionParams, sourceParams_all)}
+    return {scenarioFolder: getScenario(scenarioFolder) for scenarioFolder in scenarioFolders}
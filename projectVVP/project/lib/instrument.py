@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import resource
+import threading
+
+
+#Stage-level timing and memory instrumentation
+#Pipeline stages and core calls of ge are wrapped in spans:
+#   with instrument.span("computeFieldStack", stabilityClass="A"):
+#       ...
+#Each span records its duration, resident memory (RSS) at start and peak RSS sampled during the span, and its attributes
+#(e.g. stability class, sources of the batch). Counters (e.g. optimizer iterations, cache hits) are summed by count.
+#Instrumentation is disabled by default - span then returns one shared empty context and count returns immediately,
+#so instrumented code runs with negligible overhead. It is enabled by enable() (main.py: --profile REPORT or
+#environment variable VVP_PROFILE=REPORT) and the report is written by writeReport.
+#Only spans of the process which enabled the instrumentation are recorded (not spans in worker processes).
+
+#environment variable with name of the report file, which enables the instrumentation
+profileVariable = "VVP_PROFILE"
+
+_enabled = False
+_startTime = 0.0
+_spans = []
+_openSpans = []
+_counters = {}
+_sampler = None
+
+
+class _NoSpan:
+    #empty context returned by span when instrumentation is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        return False
+
+    def annotate(self, **attributes) -> None:
+        pass
+
+
+_noSpan = _NoSpan()
+
+
+class _Span:
+    #context recording one span (see span)
+    def __init__(self, name: str, attributes: dict):
+        self.record = {"name": name, "parent": _openSpans[-1].record["name"] if _openSpans else None, "attributes": attributes}
+
+    def __enter__(self):
+        self.record["start"] = time.perf_counter() - _startTime
+        self.record["rssStart"] = currentRss()
+        self.record["rssPeak"] = self.record["rssStart"]
+        _openSpans.append(self)
+        return self
+
+    def __exit__(self, *excInfo):
+        self.record["duration"] = time.perf_counter() - _startTime - self.record["start"]
+        self.record["rssPeak"] = max(self.record["rssPeak"], currentRss())
+        _openSpans.remove(self)
+        _spans.append(self.record)
+        return False
+
+    def annotate(self, **attributes) -> None:
+        #add attributes known only at the end of the span (e.g. number of iterations)
+        self.record["attributes"].update(attributes)
+
+
+class _MemorySampler(threading.Thread):
+    #thread sampling RSS of the process, peak RSS of all open spans is updated by each sample
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            rss = currentRss()
+            for openSpan in list(_openSpans):
+                if rss > openSpan.record["rssPeak"]:
+                    openSpan.record["rssPeak"] = rss
+
+
+def currentRss() -> int:
+    #Current resident memory of the process in bytes (peak resident memory, where current is not available)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #ru_maxrss is in kilobytes on Linux, in bytes on macOS
+        return maxRss if os.uname().sysname == "Darwin" else maxRss*1024
+
+
+def enable(sampleInterval: float | None = 0.01) -> None:
+    #Enable instrumentation (clear recorded spans and counters)
+    #sampleInterval: interval [s] of sampling RSS for peak memory of spans (None = RSS only at start and end of spans)
+    global _enabled, _startTime, _sampler
+    disable()
+    _spans.clear()
+    _counters.clear()
+    _startTime = time.perf_counter()
+    _enabled = True
+    if sampleInterval is not None:
+        _sampler = _MemorySampler(sampleInterval)
+        _sampler.start()
+
+
+def disable() -> None:
+    #Disable instrumentation (recorded spans and counters are kept for the report)
+    global _enabled, _sampler
+    _enabled = False
+    if _sampler is not None:
+        _sampler.stopped.set()
+        _sampler.join()
+        _sampler = None
+
+
+def isEnabled() -> bool:
+    return _enabled
+
+
+def span(name: str, **attributes):
+    #Context manager recording one span with given name and attributes (empty context if instrumentation is disabled)
+    if not _enabled:
+        return _noSpan
+    return _Span(name, attributes)
+
+
+def count(name: str, value: float = 1) -> None:
+    #Add value to counter with given name (e.g. optimizer iterations, cache hits)
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def summary() -> dict:
+    #Aggregate recorded spans:
+    #  "stages" - for each span name number of calls, total and maximal duration and peak RSS
+    #  "classes" - total duration of field computation spans (with stabilityClass and sources attributes), for each stability class
+    #sources of one batch are evaluated together in one numpy pass, so time of each source is not known
+    #(spans record only which sources the batch contains)
+    stages = {}
+    classes = {}
+    for record in _spans:
+        stage = stages.setdefault(record["name"], {"calls": 0, "totalTime": 0.0, "maxTime": 0.0, "rssPeak": 0})
+        stage["calls"] += 1
+        stage["totalTime"] += record["duration"]
+        stage["maxTime"] = max(stage["maxTime"], record["duration"])
+        stage["rssPeak"] = max(stage["rssPeak"], record["rssPeak"])
+        attributes = record["attributes"]
+        if "stabilityClass" in attributes and "sources" in attributes:
+            classes[attributes["stabilityClass"]] = classes.get(attributes["stabilityClass"], 0.0) + record["duration"]
+    return {"stages": stages, "classes": classes}
+
+
+def writeReport(fileName: str, **runInfo) -> None:
+    #Write json report with run information, summary, counters and all recorded spans
+    report = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "run": runInfo,
+              "totalTime": time.perf_counter() - _startTime,
+              "rssPeak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if os.uname().sysname == "Darwin" else 1024),
+              "summary": summary(), "counters": dict(_counters), "spans": list(_spans)}
+    with open(fileName, "w") as f:
+        json.dump(report, f, indent=1, default=str)
@@ -1,28 +1,139 @@
+import os
+import json
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from numpy.typing import NDArray
 
-def createGraphs(concField: NDArray[np.float64] , fileName: str, title: str, domainParams: list[float]) -> None:
+
+#Output formats of concentration fields (see saveField):
+#  "npy" - binary numpy file, metadata in .json file of the same name (file can be memory-mapped by loadField)
+#  "npz" - numpy archive with field and metadata (optionally compressed)
+#  "chunked" - as "npy", but written in blocks of rows, so that whole field (e.g. memory-mapped field from ge.streamImissionStats)
+#              is never loaded into memory, also during conversion to float32
+#  "csv" - text file with metadata in header line (slow and large for fine domains, kept for export)
+outputFormats = ["npy", "npz", "chunked", "csv"]
+
+
+def fieldMetadata(domainParams: list[float], stabilityClass: str | None = None, scenario: str | None = None, **extra) -> dict:
+    #Metadata stored with concentration field - domain size, resolution, stability class, scenario and any other values
+    metadata = {"domainSize": [float(domainParams[0]), float(domainParams[1])], "resolution": int(domainParams[2]),
+                "stabilityClass": stabilityClass, "scenario": scenario, "units": "g.m-3"}
+    metadata.update(extra)
+    return metadata
+
+
+def saveField(concField: NDArray[np.float64], fileName: str, fileFormat: str = "npy", float32: bool = False, compress: bool = False, metadata: dict | None = None, chunkRows: int = 256) -> str:
+    #Save concentration field in selected format (see outputFormats)
+    #fileName: name without extension (e.g. './output/imissionConc_optimal'), extension is given by the format
+    #float32: store values in single precision (half size)
+    #compress: compress the field (only "npz" format)
+    #Return name of the written file
+    if fileFormat not in outputFormats:
+        raise ValueError("Unknown output format: " + fileFormat)
+    dtype = np.float32 if float32 else np.float64
+    metadata = {} if metadata is None else dict(metadata)
+    metadata["dtype"] = np.dtype(dtype).name
+    fileName = fileName + "." + ("npy" if fileFormat == "chunked" else fileFormat)
+    if fileFormat == "npy":
+        np.save(fileName, np.asarray(concField, dtype=dtype))
+    elif fileFormat == "chunked":
+        fileField = np.lib.format.open_memmap(fileName, mode="w+", dtype=dtype, shape=concField.shape)
+        for rowStart in range(0, concField.shape[0], chunkRows):
+            fileField[rowStart:rowStart+chunkRows] = concField[rowStart:rowStart+chunkRows]
+        fileField.flush()
+        del fileField
+    elif fileFormat == "npz":
+        saveArchive = np.savez_compressed if compress else np.savez
+        saveArchive(fileName, field=np.asarray(concField, dtype=dtype), metadata=json.dumps(metadata))
+    else:
+        np.savetxt(fileName, concField, delimiter=",", header=json.dumps(metadata), fmt="%.9g" if float32 else "%.18e")
+    if fileFormat in ("npy", "chunked"):
+        with open(os.path.splitext(fileName)[0] + ".json", "w") as f:
+            json.dump(metadata, f)
+    return fileName
+
+
+def loadField(fileName: str, mmap: bool = True) -> tuple[NDArray, dict]:
+    #Load concentration field saved by saveField (file name with extension)
+    #.npy fields are memory-mapped (read only) if mmap is True, so only the used parts are read from disk
+    #Return field and its metadata
+    if fileName.endswith(".npy"):
+        concField = np.load(fileName, mmap_mode="r" if mmap else None)
+        metadataFile = os.path.splitext(fileName)[0] + ".json"
+        metadata = {}
+        if os.path.exists(metadataFile):
+            with open(metadataFile) as f:
+                metadata = json.load(f)
+        return concField, metadata
+    if fileName.endswith(".npz"):
+        with np.load(fileName) as data:
+            return data["field"], json.loads(str(data["metadata"]))
+    with open(fileName) as f:
+        header = f.readline()
+    metadata = json.loads(header[1:]) if header.startswith("#") else {}
+    return np.loadtxt(fileName, delimiter=",", ndmin=2), metadata
+
+
+#Graphs are drawn on separate figures through object-oriented interface of matplotlib with Agg backend (no pyplot global state,
+#no display needed), so that several graphs can be rendered at once in worker processes (see renderGraphs).
+#matplotlib is imported only when graphs are rendered.
+
+#types of graphs created for each concentration field (file names end with _scalar.png and _contour.png)
+plotTypes = ["scalar", "contour"]
+
+
+@functools.lru_cache(maxsize=8)
+def domainMeshgrid(xkm: float, ykm: float, n: int) -> tuple[NDArray[np.float64], NDArray[np.float64]]:
+    #coordinates of nodes of the domain for contour graph (same for all graphs of the domain, so computed only once)
+    x = np.linspace(0, xkm, n)
+    y = np.linspace(0, ykm, n)
+    return np.meshgrid(x, y)
+
+
+def renderGraph(concField: NDArray[np.float64], fileName: str, title: str, domainParams: list[float], plotType: str) -> str:
+    #create one graph of concentration field (plotType "scalar" or "contour") and save it as './output/' + fileName + '_' + plotType + '.png'
+    #Return name of the saved file
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if plotType == "scalar":
+        #print  imission concentrations
+        ax.imshow(concField, cmap='viridis', origin='lower', aspect='auto')
+    elif plotType == "contour":
+        #print  imission concentrations - contour version
+        X, Y = domainMeshgrid(domainParams[0], domainParams[1], domainParams[2])
+        cnt = ax.contour(X, Y, concField, 10, cmap="jet")
+        fig.colorbar(cnt, ax=ax)
+    else:
+        raise ValueError("Unknown plot type: " + plotType)
+    ax.set_title(title)
+    plotFileName = './output/' + fileName + '_' + plotType + '.png'
+    fig.savefig(plotFileName)
+    return plotFileName
+
+
+def createGraphs(concField: NDArray[np.float64] | str, fileName: str, title: str, domainParams: list[float]) -> list[str]:
     #for concentration field in computed domain create scalar and contour graph, 
     #save them under the specified names
-    #print  imission concentrations
-    plt.imshow(concField, cmap='viridis', origin='lower', aspect='auto')
-    plt.title(title)
-    fileName1 = './output/' + fileName + '_scalar.png'
-    #fileName1 = fileName + '_scalar.png'
-    plt.savefig(fileName1)
-    #plt.show()
-    plt.clf()
-    #print  imission concentrations - contour version
-    x = np.linspace(0, domainParams[0], domainParams[2])
-    y = np.linspace(0, domainParams[1], domainParams[2])
-    X, Y = np.meshgrid(x, y)
-    cnt = plt.contour(X, Y, concField, 10, cmap="jet")
-    plt.colorbar()
-    plt.title(title)
-    fileName2 = './output/' + fileName + '_contour.png'
-    #fileName2 = fileName + '_contour.png'
-    plt.savefig(fileName2)
-    #plt.show()
-    plt.clf()
+    #concField can be also name of .npy file with the field, which is then memory-mapped (see loadField)
+    #Return names of saved files
+    if isinstance(concField, str):
+        concField, metadata = loadField(concField)
+    return [renderGraph(concField, fileName, title, domainParams, plotType) for plotType in plotTypes]
+
 
+def renderGraphs(graphs: list[tuple[NDArray[np.float64] | str, str, str]], domainParams: list[float], workers: int | None = None) -> list[str]:
+    #Create scalar and contour graphs (as createGraphs) for all given concentration fields
+    #graphs: list of (concentration field or name of its .npy file, fileName, title)
+    #graphs of each field are rendered in one job (field is sent to a worker only once), in a pool of workers processes
+    #(workers=None - number of CPUs, 1 - serially in this process). Large fields (e.g. memory-mapped fields of streaming mode)
+    #should be given by file name, so that each worker memory-maps the file instead of receiving a copy of the field.
+    #Return names of saved files
+    if workers == 1 or not graphs:
+        return [plotFileName for graph in graphs for plotFileName in createGraphs(*graph, domainParams)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(createGraphs, *graph, domainParams) for graph in graphs]
+        return [plotFileName for job in jobs for plotFileName in job.result()]
@@ -0,0 +1,112 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from numpy.typing import NDArray
+
+
+from lib import ge
+from lib import fieldcache
+
+
+#Parallel computation of the field stack (same results as ge.computeFieldStack)
+#Jobs - one stability class and one batch of sources - are independent and are distributed over a pool of worker processes.
+#Workers write results directly into shared memory arrays created by the parent process,
+#so computed fields are not pickled and sent back to the parent.
+
+#shared arrays attached in worker process (set by _attachSharedArrays)
+_sharedArrays = {}
+
+
+def _createSharedArray(shape: tuple) -> tuple[shared_memory.SharedMemory, NDArray[np.float64]]:
+    #create shared memory block and numpy array of given shape (filled by zeros) using it
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*np.dtype(np.float64).itemsize))
+    array = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    array[...] = 0
+    return shm, array
+
+
+def _attachSharedArrays(sharedSpecs: dict) -> None:
+    #worker initializer - attach shared memory blocks created by parent process
+    #sharedSpecs: {array name: (shared memory name, shape)}
+    for arrayName, (shmName, shape) in sharedSpecs.items():
+        shm = shared_memory.SharedMemory(name=shmName)
+        _sharedArrays[arrayName] = (shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf))
+
+
+def _stackJob(i: int, fieldIndex: int | None, batchStart: int, sourceParams_batch: list[list[float]], zCoor: float, dispersionParams: list[float], domainParams: list[float], stabilityClass: str, cacheDir: str | None, tolerance: float | None) -> None:
+    #compute total concentration fields for one stability class and one batch of sources, write results to shared arrays
+    #(fields are stored at index fieldIndex of the field stack, None = fields of this class are not returned)
+    totalConcField = ge.totalConcFieldBatch(sourceParams_batch, zCoor, dispersionParams, domainParams, stabilityClass, cacheDir, tolerance)
+    cumulativeImission = _sharedArrays["cumulativeImission"][1]
+    cumulativeImission[i, batchStart:batchStart+len(sourceParams_batch)] = totalConcField.sum(axis=(1,2))
+    if "totalConcFields" in _sharedArrays and fieldIndex is not None:
+        _sharedArrays["totalConcFields"][1][fieldIndex, batchStart:batchStart+len(sourceParams_batch)] = totalConcField
+
+
+def computeFieldStackParallel(sourceParams_all: list[list[float]], dispersionParams: list[float], domainParams: list[float], stabilityClasses: list[str], zCoor: float = 2, returnFields: bool = False, cacheDir: str | None = None, cacheMaxBytes: int = 2*1024**3, tolerance: float | None = None, workers: int | None = None, fieldClasses: list[str] | None = None):
+    #Parallel version of ge.computeFieldStack, with the same arguments and return values
+    #workers: number of worker processes (default: number of CPUs)
+    #Each source is computed by the same code as in serial version, so results are identical to ge.computeFieldStack
+    n = domainParams[2]
+    sourceCount = len(sourceParams_all)
+    if workers is None:
+        workers = os.cpu_count()
+    #split sources into batches small enough to give every worker several jobs, but not larger than serial batches
+    batchCount = -(-4*workers // len(stabilityClasses))
+    batchSize = max(1, min(ge.stackBatchSize(n), -(-sourceCount // batchCount)))
+
+    if fieldClasses is None:
+        fieldClasses = stabilityClasses
+
+    sharedBlocks = {}
+    sharedBlocks["cumulativeImission"] = _createSharedArray((len(stabilityClasses), sourceCount))
+    if returnFields:
+        sharedBlocks["totalConcFields"] = _createSharedArray((len(fieldClasses), sourceCount, n, n))
+    sharedSpecs = {arrayName: (shm.name, array.shape) for arrayName, (shm, array) in sharedBlocks.items()}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attachSharedArrays, initargs=(sharedSpecs,)) as pool:
+            jobs = []
+            for i in range(len(stabilityClasses)):
+                for batchStart in range(0, sourceCount, batchSize):
+                    batch = sourceParams_all[batchStart:batchStart+batchSize]
+                    fieldIndex = fieldClasses.index(stabilityClasses[i]) if stabilityClasses[i] in fieldClasses else None
+                    jobs.append(pool.submit(_stackJob, i, fieldIndex, batchStart, batch, zCoor, dispersionParams, domainParams, stabilityClasses[i], cacheDir, tolerance))
+            for job in jobs:
+                job.result() #re-raise exceptions from workers
+        #copy results out of shared memory before it is released
+        cumulativeImission = sharedBlocks["cumulativeImission"][1].copy()
+        if returnFields:
+            totalConcFields = sharedBlocks["totalConcFields"][1].copy()
+    finally:
+        #release numpy views first, shared memory block can't be closed while they exist
+        for arrayName in list(sharedBlocks):
+            shm, array = sharedBlocks.pop(arrayName)
+            del array
+            shm.close()
+            shm.unlink()
+
+    if cacheDir is not None:
+        fieldcache.evict(cacheDir, cacheMaxBytes)
+    if returnFields:
+        return cumulativeImission, totalConcFields
+    return cumulativeImission
+
+
+def measureSpeedup(sourceParams_all: list[list[float]], dispersionParams: list[float], domainParams: list[float], stabilityClasses: list[str], workers: int | None = None) -> dict:
+    #Compute cumulative imission matrix serially (ge.computeFieldStack) and in parallel (computeFieldStackParallel)
+    #Return dictionary with run times, speedup and check that both results are identical
+    start = time.perf_counter()
+    serialResult = ge.computeFieldStack(sourceParams_all, dispersionParams, domainParams, stabilityClasses)
+    serialTime = time.perf_counter() - start
+    start = time.perf_counter()
+    parallelResult = computeFieldStackParallel(sourceParams_all, dispersionParams, domainParams, stabilityClasses, workers=workers)
+    parallelTime = time.perf_counter() - start
+    return {"sourceCount": len(sourceParams_all),
+            "resolution": domainParams[2],
+            "workers": workers if workers is not None else os.cpu_count(),
+            "serialTime": serialTime,
+            "parallelTime": parallelTime,
+            "speedup": serialTime/parallelTime,
+            "identical": bool(np.array_equal(serialResult, parallelResult))}
@@ -0,0 +1,175 @@
+import os
+import csv
+import collections
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from numpy.typing import NDArray
+
+
+from lib import domain
+from lib import ge
+from lib import getinput
+from lib import fieldcache
+
+
+#Multi-scenario sweep
+#Scenarios usually differ only in a few inputs (scenario folder, wind velocity, emission rate, power shares, ...).
+#Cumulative imission of a source is linear in its emission rate and in wind rose shares:
+#   cumulativeImission[class, source] = emission * summ over wind directions d of windRose[d]*directionSum[key, d]
+#where directionSum[key, d] is summ of concentration field of the source at unit emission for wind direction d
+#and key identifies the field shape (fieldcache.fieldKey - domain, source position and stack parameters, temperature,
+#wind velocity, stability class). Direction summs are computed only once for each distinct key over all scenarios
+#(in a pool of worker processes), cumulative imission matrix of every scenario is then assembled from them.
+
+#parameters which can be swept (values of the parameter grid), and what they change in the scenario:
+#  "temperature" - atmospheric temperature dispersionParams[0]
+#  "windSpeed" - wind velocity dispersionParams[1]
+#  "windRose" - shares of wind directions dispersionParams[2:]
+#  "resolution" - number of nodes domainParams[2]
+#  "emission" - emission rate of the main (first) source sourceParams[6]
+#  "powerShares" - coefficients of total power constraint of ge.minimizeImissions (None = ge.powerShareCoef)
+#stack height is not swept - effective plume height (ge.effectivePlumeHeight) doesn't depend on it yet
+sweepParams = ["temperature", "windSpeed", "windRose", "resolution", "emission", "powerShares"]
+
+
+def expandGrid(scenarioFolders: list[str], paramGrid: dict) -> list[dict]:
+    #Create list of scenarios - all combinations of scenario folders and values of swept parameters
+    #paramGrid: {parameter name (from sweepParams): list of values}, e.g. {"windSpeed": [1.2, 2.4], "emission": [0.1, 0.2]}
+    #Return list of dictionaries {"name": ..., "scenario": scenario folder, parameter name: value, ...}
+    for paramName in paramGrid:
+        if paramName not in sweepParams:
+            raise ValueError("Unknown sweep parameter: " + paramName)
+    scenarios = []
+    for scenarioFolder in scenarioFolders:
+        for values in itertools.product(*paramGrid.values()):
+            scenario = {"scenario": scenarioFolder}
+            scenario.update(zip(paramGrid.keys(), values))
+            nameParts = [os.path.basename(os.path.normpath(scenarioFolder))]
+            nameParts += [paramName + "=" + str(value) for paramName, value in zip(paramGrid.keys(), values) if paramName not in ("windRose", "powerShares")]
+            scenario["name"] = "_".join(nameParts)
+            scenarios.append(scenario)
+    #combinations which differ only in wind rose or power shares get unique names by their index
+    #(duplicates are counted before any name is changed, so that all scenarios of a duplicated group get the index)
+    nameCounts = collections.Counter(scenario["name"] for scenario in scenarios)
+    for indx, scenario in enumerate(scenarios):
+        if nameCounts[scenario["name"]] > 1:
+            scenario["name"] += "_" + str(indx)
+    return scenarios
+
+
+def applySweepParams(scenarioData: tuple[list[float], list[float], list[list[float]]], scenario: dict) -> tuple[list[float], list[float], list[list[float]], list[float]]:
+    #Apply swept parameters of the scenario to input data of its scenario folder (see getinput.getScenario)
+    #Return domainParams, dispersionParams, sourceParams_all and powerShares of the scenario
+    domainParams, dispersionParams, sourceParams_all = scenarioData
+    domainParams = list(domainParams)
+    dispersionParams = list(dispersionParams)
+    sourceParams_all = [list(sourceParams) for sourceParams in sourceParams_all]
+    if "temperature" in scenario:
+        dispersionParams[0] = scenario["temperature"]
+    if "windSpeed" in scenario:
+        dispersionParams[1] = scenario["windSpeed"]
+    if "windRose" in scenario:
+        dispersionParams[2:] = list(scenario["windRose"])
+    if "resolution" in scenario:
+        domainParams[2] = int(scenario["resolution"])
+    if "emission" in scenario:
+        sourceParams_all[0][6] = scenario["emission"]
+    powerShares = scenario.get("powerShares")
+    if powerShares is None:
+        powerShares = ge.powerShareCoef(sourceParams_all)
+    return domainParams, dispersionParams, sourceParams_all, list(powerShares)
+
+
+def _directionSumsJob(sourceParams_batch: list[list[float]], zCoor: float, dispersionParams: list[float], domainParams: list[float], stabilityClass: str, cacheDir: str | None, tolerance: float | None) -> NDArray[np.float64]:
+    #summs of fields at unit emission through whole domain for a batch of sources, for each wind direction
+    #Return array [source, wind direction]
+    unitSourceParams = [list(sourceParams[0:6]) + [1.0] for sourceParams in sourceParams_batch]
+    if cacheDir is None:
+        directionFields = ge.gaussDispEqStack(unitSourceParams, zCoor, dispersionParams, domainParams, stabilityClass, tolerance)
+    else:
+        directionFields = ge.gaussDispEqStackCached(unitSourceParams, zCoor, dispersionParams, domainParams, stabilityClass, cacheDir, tolerance)
+    return directionFields.sum(axis=(2,3))
+
+
+def computeDirectionSums(scenarioInputs: list[tuple], stabilityClasses: list[str], zCoor: float = 2, cacheDir: str | None = None, tolerance: float | None = None, workers: int | None = None) -> dict[str, NDArray[np.float64]]:
+    #Compute direction summs (see _directionSumsJob) for every distinct field of all scenarios, each of them only once
+    #scenarioInputs: list of (domainParams, dispersionParams, sourceParams_all, powerShares) (see applySweepParams)
+    #Return dictionary {fieldcache.fieldKey: array of direction summs [wind direction]}
+    #fields with the same domain, temperature, wind velocity and stability class are computed together in batches
+    groups = {}
+    for domainParams, dispersionParams, sourceParams_all, powerShares in scenarioInputs:
+        #direction summs are reweighted by wind rose of each scenario, so the wind rose must have sectors of domain.windDirections
+        ge.checkWindRose(dispersionParams)
+        for stabilityClass in stabilityClasses:
+            groupKey = (tuple(domainParams[0:3]), tuple(dispersionParams[0:2]), stabilityClass)
+            group = groups.setdefault(groupKey, {})
+            for sourceParams in sourceParams_all:
+                key = fieldcache.fieldKey(sourceParams, dispersionParams, domainParams, stabilityClass, zCoor, domain.windDirections, tolerance)
+                group.setdefault(key, sourceParams)
+
+    directionSums = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = []
+        for (domainParams, dispersionParams, stabilityClass), group in groups.items():
+            keys = list(group)
+            batchSize = ge.stackBatchSize(domainParams[2])
+            for batchStart in range(0, len(keys), batchSize):
+                batchKeys = keys[batchStart:batchStart+batchSize]
+                job = pool.submit(_directionSumsJob, [group[key] for key in batchKeys], zCoor, list(dispersionParams), list(domainParams), stabilityClass, cacheDir, tolerance)
+                jobs.append((batchKeys, job))
+        for batchKeys, job in jobs:
+            directionSums.update(zip(batchKeys, job.result()))
+    return directionSums
+
+
+def scenarioImissionCums(scenarioInput: tuple, directionSums: dict[str, NDArray[np.float64]], stabilityClasses: list[str], zCoor: float = 2, tolerance: float | None = None) -> NDArray[np.float64]:
+    #Assemble cumulative imission matrix [stability class, source] of one scenario from direction summs (see computeDirectionSums)
+    domainParams, dispersionParams, sourceParams_all, powerShares = scenarioInput
+    ge.checkWindRose(dispersionParams)
+    windRose = np.array(dispersionParams[2:], dtype=np.float64)
+    cumulativeImission = np.zeros(shape = (len(stabilityClasses), len(sourceParams_all)))
+    for i in range(len(stabilityClasses)):
+        for indx, sourceParams in enumerate(sourceParams_all):
+            key = fieldcache.fieldKey(sourceParams, dispersionParams, domainParams, stabilityClasses[i], zCoor, domain.windDirections, tolerance)
+            cumulativeImission[i, indx] = sourceParams[6]*(windRose@directionSums[key])
+    return cumulativeImission
+
+
+def runSweep(scenarios: list[dict], stabilityClasses: list[str], zCoor: float = 2, cacheDir: str | None = None, tolerance: float | None = None, method: str = "linprog", workers: int | None = None, summaryFile: str | None = None) -> list[dict]:
+    #Run all scenarios (see expandGrid): cumulative imissions from shared direction summs and optimal power shares
+    #(ge.minimizeImissions) of each scenario
+    #Return list of results {"name", "scenario", swept parameters, "sourceCount", "objective",
+    #"cumulativeImission_nominal", "cumulativeImission_optimal", "share_0", "share_1", ...} - one for each scenario,
+    #which is also written to summaryFile (csv) if given
+    scenarioData = getinput.getScenarios(list(dict.fromkeys(scenario["scenario"] for scenario in scenarios)))
+    scenarioInputs = [applySweepParams(scenarioData[scenario["scenario"]], scenario) for scenario in scenarios]
+    directionSums = computeDirectionSums(scenarioInputs, stabilityClasses, zCoor, cacheDir, tolerance, workers)
+
+    results = []
+    for scenario, scenarioInput in zip(scenarios, scenarioInputs):
+        cumulativeImission = scenarioImissionCums(scenarioInput, directionSums, stabilityClasses, zCoor, tolerance)
+        sourcePowerOutputs, optimizerInfo = ge.minimizeImissions(cumulativeImission, scenarioInput[3], method=method, fullOutput=True)
+        result = {"name": scenario["name"], "scenario": scenario["scenario"]}
+        result.update((paramName, scenario[paramName]) for paramName in sweepParams if paramName in scenario)
+        result.update({"sourceCount": len(sourcePowerOutputs),
+                       "objective": optimizerInfo["objective"],
+                       #all sources at nominal power and all sources at optimal power output, summ through all stability classes
+                       "cumulativeImission_nominal": float(cumulativeImission.sum()),
+                       "cumulativeImission_optimal": float((cumulativeImission@sourcePowerOutputs).sum())})
+        result.update(("share_" + str(source), float(sourcePowerOutputs[source])) for source in range(len(sourcePowerOutputs)))
+        results.append(result)
+
+    if summaryFile is not None:
+        writeSummary(results, summaryFile)
+    return results
+
+
+def writeSummary(results: list[dict], summaryFile: str) -> None:
+    #Write results of the sweep into csv file, one row for each scenario
+    #(scenarios with less sources have empty share columns of missing sources)
+    columns = list(dict.fromkeys(column for result in results for column in result))
+    with open(summaryFile, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from numpy.typing import NDArray
+
+
+from lib import ge
+from lib import getinput
+from lib import instrument
+
+
+#Hourly meteorological time series mode
+#Each hour of the time series (wind direction, wind velocity, temperature, stability class - see getinput.getMeteoSeries)
+#is evaluated with the dispersion model and reduced into accumulator of annual statistics for each node of the domain:
+#  "records" - number of processed hours
+#  "sum" - summ of hourly concentrations (for annual mean)
+#  "max" - maximal hourly concentration
+#  "top" - topCount highest hourly concentrations (unsorted), for high percentiles (e.g. 99.8th percentile)
+#Accumulators of separate parts of the year (e.g. months) can be merged, and can be saved and loaded to resume the computation.
+
+
+def topCount(quantile: float, expectedHours: int = 8760) -> int:
+    #Number of highest values, which must be kept for each node to get quantile of expectedHours hourly values
+    return int(np.ceil((1 - quantile)*expectedHours)) + 1
+
+
+def createAccumulator(n: int, topValues: int) -> dict:
+    #Create empty accumulator for domain with n x n nodes, keeping topValues highest values for each node
+    return {"records": 0,
+            "sum": np.zeros(shape = (n,n)),
+            "max": np.zeros(shape = (n,n)),
+            "top": np.zeros(shape = (topValues,n,n))}
+
+
+def updateAccumulator(acc: dict, concField: NDArray[np.float64]) -> None:
+    #Add concentration field of one hour to the accumulator
+    acc["records"] += 1
+    acc["sum"] += concField
+    np.maximum(acc["max"], concField, out=acc["max"])
+    #replace the lowest of kept values of each node, if the new value is higher
+    lowest = acc["top"].argmin(axis=0)[np.newaxis]
+    newTop = np.maximum(np.take_along_axis(acc["top"], lowest, axis=0), concField)
+    np.put_along_axis(acc["top"], lowest, newTop, axis=0)
+
+
+def mergeAccumulators(acc1: dict, acc2: dict) -> dict:
+    #Merge accumulators of two separate parts of the time series (e.g. two months)
+    topValues = acc1["top"].shape[0]
+    top = np.concatenate([acc1["top"], acc2["top"]])
+    top = -np.partition(-top, topValues-1, axis=0)[:topValues]
+    return {"records": acc1["records"] + acc2["records"],
+            "sum": acc1["sum"] + acc2["sum"],
+            "max": np.maximum(acc1["max"], acc2["max"]),
+            "top": top}
+
+
+def saveAccumulator(acc: dict, fileName: str) -> None:
+    #Save accumulator to .npz file (written to temporary file first, so that interrupted save does not damage previous state)
+    tmpFileName = fileName + ".tmp.npz"
+    np.savez(tmpFileName, **acc)
+    os.replace(tmpFileName, fileName)
+
+
+def loadAccumulator(fileName: str) -> dict:
+    #Load accumulator saved by saveAccumulator
+    with np.load(fileName) as data:
+        acc = {key: data[key] for key in data.files}
+    acc["records"] = int(acc["records"])
+    return acc
+
+
+def annualStats(acc: dict, quantile: float = 0.998) -> dict:
+    #Compute annual statistics from the accumulator
+    #Return dictionary with fields of annual mean, maximum and quantile (nearest rank) of hourly concentrations,
+    #"exact" is False if more hours were processed than expected when the accumulator was created,
+    #then quantile is approximated by the lowest kept value - it is the topValues-th highest hourly value, which is not lower
+    #than the exact quantile (conservative upper bound of the quantile)
+    records = acc["records"]
+    #position of the quantile in hourly values of each node sorted from the highest
+    position = records - int(np.ceil(quantile*records))
+    topValues = acc["top"].shape[0]
+    top = -np.sort(-acc["top"], axis=0)
+    return {"records": records,
+            "mean": acc["sum"]/max(records, 1),
+            "max": acc["max"],
+            "quantile": quantile,
+            "percentile": top[min(position, topValues-1)],
+            "exact": position < topValues}
+
+
+def hourConcField(record: tuple, sourceParams_all: list[list[float]], domainParams: list[float], zCoor: float = 2, minWindSpeed: float = 0.5) -> NDArray[np.float64]:
+    #Compute total concentration field of all sources for one hour of the time series
+    #record: (windDirection [degrees, direction the wind blows from, 0 = N, 90 = E], windSpeed, temperature, stabilityClass),
+    #see getinput.getMeteoSeries
+    #wind velocity lower than minWindSpeed (calm) is raised to minWindSpeed (gaussian plume equation is not defined for calm)
+    windDirection, windSpeed, temperature, stabilityClass = record
+    #wind blows toward windDirection + 180 degrees (clockwise from N) -> down-wind angle from x axis of the domain
+    #(see domain.windSectorAngles)
+    angle = np.radians(90 - (windDirection + 180))
+    return ge.gaussDispEqFieldAngle(sourceParams_all, zCoor, [temperature, max(windSpeed, minWindSpeed)], domainParams, angle, stabilityClass)
+
+
+def runMeteoSeries(meteoFile: str, sourceParams_all: list[list[float]], domainParams: list[float], quantile: float = 0.998, expectedHours: int = 8760, zCoor: float = 2, minWindSpeed: float = 0.5, chunkSize: int = 744, startRecord: int = 0, stopRecord: int | None = None, stateFile: str | None = None) -> dict:
+    #Evaluate hourly meteorological time series (records startRecord, ..., stopRecord-1) and return accumulator of statistics
+    #Time series is read in chunks of chunkSize hours, so memory does not depend on the length of the time series.
+    #If stateFile is given, accumulator is saved after each chunk and the computation continues from the saved state
+    #when it is run again (e.g. after interruption).
+    if stateFile is not None and os.path.exists(stateFile):
+        acc = loadAccumulator(stateFile)
+    else:
+        acc = createAccumulator(domainParams[2], topCount(quantile, expectedHours))
+    for chunk in getinput.getMeteoSeries(meteoFile, chunkSize, startRecord + acc["records"], stopRecord):
+        with instrument.span("meteoChunk", records=len(chunk)):
+            for record in chunk:
+                updateAccumulator(acc, hourConcField(record, sourceParams_all, domainParams, zCoor, minWindSpeed))
+        if stateFile is not None:
+            saveAccumulator(acc, stateFile)
+    return acc
+
+
+def runMeteoSeriesParallel(meteoFile: str, sourceParams_all: list[list[float]], domainParams: list[float], quantile: float = 0.998, expectedHours: int = 8760, zCoor: float = 2, minWindSpeed: float = 0.5, partSize: int = 744, stateDir: str | None = None, workers: int | None = None) -> dict:
+    #Evaluate hourly meteorological time series in parts of partSize hours (default 744 hours = 31 days, i.e. by month)
+    #in a pool of worker processes, and merge accumulators of all parts
+    #If stateDir is given, state of each part is saved there, so interrupted computation continues from saved states.
+    recordCount = sum(len(chunk) for chunk in getinput.getMeteoSeries(meteoFile))
+    if stateDir is not None:
+        os.makedirs(stateDir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = []
+        for partStart in range(0, recordCount, partSize):
+            stateFile = None if stateDir is None else os.path.join(stateDir, "part_" + str(partStart) + ".npz")
+            parts.append(pool.submit(runMeteoSeries, meteoFile, sourceParams_all, domainParams, quantile, expectedHours, zCoor, minWindSpeed,
+                                     partSize, partStart, partStart + partSize, stateFile))
+        acc = createAccumulator(domainParams[2], topCount(quantile, expectedHours))
+        for part in parts:
+            acc = mergeAccumulators(acc, part.result())
+    return acc
@@ -1,12 +1,16 @@
+import os
+import argparse
 import numpy as np
 import scipy.optimize as spopt
-import matplotlib.pyplot as plt
 
 
 from lib import getinput
 from lib import output
 from lib import domain
 from lib import ge
+from lib import parallel
+from lib import timeseries
+from lib import instrument
 
 
 #==================================================INPUT==============================================================================#
@@ -16,91 +20,215 @@ from lib import ge
 #However, some kind of numerical relation between power output and corresponding emission rate should be formulated 
 #(for example using emission factors for respective kind of fuel, fuel calorific value and fuel consuption)
 
-#TO DO: sources are imported one by one, should be automated (automatic identification of number of source files, without need to explicitly import them)
-#CHANGE OF SOURCE COUNT: delete or add new source files
+#All sources of the scenario are found automatically (see getinput.getScenarioSources):
+#sources.npz or sources.csv (one row for each source, main source first), if present in the scenario folder,
+#otherwise sourceMain.txt and all sourceDistributed_XX.txt files
+#CHANGE OF SOURCE COUNT: delete or add new source files (or rows of sources.csv)
 sourceFolder = "./input/v01/"
-domainParams, dispersionParams = getinput.getInputData(sourceFolder + "domain.txt", sourceFolder + "dispersion.txt")
-sourceParams_main = getinput.getSourceData(sourceFolder +"sourceMain.txt")
-sourceParams_01 = getinput.getSourceData(sourceFolder +"sourceDistributed_01.txt")
-sourceParams_02 = getinput.getSourceData(sourceFolder +"sourceDistributed_02.txt")
-sourceParams_03 = getinput.getSourceData(sourceFolder +"sourceDistributed_03.txt")
-sourceParams_04 = getinput.getSourceData(sourceFolder +"sourceDistributed_04.txt")
-sourceParams_05 = getinput.getSourceData(sourceFolder +"sourceDistributed_05.txt")
-#CHANGE OF SOURCE COUNT: delete or add sourceParams elements
-sourceParams_all = [sourceParams_main, sourceParams_01, sourceParams_02, sourceParams_03, sourceParams_04, sourceParams_05]
 #==================================================/INPUT==============================================================================#
 
 #==================================================PARAMETERS==============================================================================#
 stabilityClass = ["A", "B", "C", "D", "E", "F"]
-#imissionLimit = 40/1000000 # microgram.m-3 to g.m-3
+#limit of concentration in each node of the domain, for each stability class (see ge.minimizeImissionsLimited),
+#None = only cumulative imissions are minimized (limit needs all fields in memory, so it is not used with tileRows)
+imissionLimit = None #40/1000000 # microgram.m-3 to g.m-3
+#folder for persistent cache of computed fields at unit emission (set to None to disable the cache)
+#with the cache, rerun with changed emission rates or wind rose shares does not recompute the fields
+fieldCacheDir = "./cache/"
+#relative tolerance for evaluation of each plume only inside its wedge (None = evaluate all nodes of the domain)
+plumeTolerance = None
+#number of worker processes for computation of fields (1 = serial computation, None = number of CPUs)
+workerCount = 1
+#compute fields in blocks of tileRows rows with bounded memory, fields for output are stored in memory-mapped files
+#(for very large domains), None = compute and keep all fields in memory
+tileRows = None
+#hourly meteorological time series for annual statistics (e.g. sourceFolder + "meteo.csv", see getinput.getMeteoSeries),
+#None = no time series evaluation
+meteoFile = None
+#percentile of hourly concentrations computed from the time series (0.998 = 99.8th percentile)
+meteoQuantile = 0.998
+#if given, optimal power outputs are computed with increasing resolution of the domain (up to resolution in domain.txt),
+#until they change by less than this tolerance (see ge.minimizeImissionsAdaptive), None = optimize at resolution from domain.txt
+#(full resolution field stack is not computed then, only output fields at resolution from domain.txt)
+adaptiveShareTolerance = None
+#receptor points (e.g. sourceFolder + "receptors.csv", see getinput.getReceptorData), where concentrations for optimal
+#power combination are computed for each stability class, None = no receptor points
+receptorFile = None
+#optimization method for ge.minimizeImissions ("linprog" or original "trust-constr")
+optimizerMethod = "linprog"
+#format of output concentration fields (see output.outputFormats): "npy", "npz", "chunked" (bounded memory, for tileRows) or "csv"
+outputFormat = "npy"
+#store output fields in single precision, compress output fields (only "npz")
+outputFloat32 = False
+outputCompress = False
+#export output fields also to csv files (slow and large for fine domains)
+csvExport = False
+#create graphs of concentration fields (False = only numerical outputs, e.g. for batch runs)
+createPlots = True
+#number of worker processes for rendering of graphs (1 = serial rendering, None = number of CPUs)
+plotWorkers = None
 #==================================================/PARAMETERS==============================================================================#
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimal combination of power outputs of heat sources with minimal imissions")
+    parser.add_argument("--profile", metavar="REPORT", default=os.environ.get(instrument.profileVariable),
+                        help="write json report with timing and memory of pipeline stages (also environment variable " + instrument.profileVariable + ")")
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable()
+
+    #=================================INPUT=DATA=============================================================================================#
+    with instrument.span("input", scenario=sourceFolder):
+        domainParams, dispersionParams, sourceParams_all = getinput.getScenario(sourceFolder)
+    if ge.rotatedWindRose(dispersionParams):
+        #finer wind rose - fields are computed by rotated plume kernel (see ge.gaussDispEq_TotalConcFieldRotated)
+        print("Wind rose with", len(dispersionParams) - 2, "sectors, fields are computed by rotated plume kernel (field cache and plume tolerance are not used)")
+    #=================================/INPUT=DATA============================================================================================#
+
+    #optimization with imission limit needs all fields in memory (not used with tileRows),
+    #adaptive optimization computes cumulative imissions itself at increasing resolutions
+    limitMode = imissionLimit is not None and tileRows is None
+    adaptiveMode = adaptiveShareTolerance is not None and not limitMode
+    #stability class of output fields (example with stability class A), field stack of all stability classes
+    #is kept in memory only for imission limit, otherwise only fields of this class
+    plotClass = stabilityClass.index("A")
+    fieldClasses = stabilityClass if limitMode else [stabilityClass[plotClass]]
+
     #=================================CUMULATIVE=IMISSION=PER=SOURCE=AND=STABILITY=CLASS===================================================#
     #Compute cumulative imission concentration (through whole domain) for each stability class and for each source (at nominal power) 
     #Cumulative imission means summ of all computed concentrationf for each point in the domain. 
     #Represent the overal imission polution of computed domain.
     # Store each cumulative value in matrix 
     #(each matrix element represent total imission polution in the domain for one source and one stability class)
-    sourceCount = len(sourceParams_all)
-    stabClassCount = len(stabilityClass)
-    cumulativeImission = np.zeros(shape = (stabClassCount,sourceCount))
-    for i in range(stabClassCount):
-        for j in range(sourceCount):
-            cumulativeImission[i,j] = ge.computeCumulativeImission(sourceParams_all[j], dispersionParams, domainParams, stabilityClass[i])
-        #=================================/CUMULATIVE=IMISSION=PER=SOURCE=AND=STABILITY=CLASS===================================================#
+    #All fields are computed in one batched call, the same stack of total concentration fields 
+    #(stability class x source, at nominal power) is used for all following steps
+    with instrument.span("cumulativeImission"):
+        if adaptiveMode:
+            #cumulative imissions are computed by ge.minimizeImissionsAdaptive, full resolution stack is not needed
+            cumulativeImission = None
+        elif tileRows is not None:
+            #streaming mode - only cumulative imissions are kept, fields for output are computed again after the optimization
+            cumulativeImission = np.array([ge.streamImissionStats(sourceParams_all, dispersionParams, domainParams, stabClass, tileRows=tileRows)["cumulativeImission"] for stabClass in stabilityClass])
+        elif workerCount == 1:
+            cumulativeImission, totalConcFields = ge.computeFieldStack(sourceParams_all, dispersionParams, domainParams, stabilityClass, returnFields=True, cacheDir=fieldCacheDir, tolerance=plumeTolerance, fieldClasses=fieldClasses)
+        else:
+            cumulativeImission, totalConcFields = parallel.computeFieldStackParallel(sourceParams_all, dispersionParams, domainParams, stabilityClass, returnFields=True, cacheDir=fieldCacheDir, tolerance=plumeTolerance, workers=workerCount, fieldClasses=fieldClasses)
+    #=================================/CUMULATIVE=IMISSION=PER=SOURCE=AND=STABILITY=CLASS===================================================#
 
     
     #=================================MINIMIZE=CUMULATIVE=IMISSIONS=OF=ALL=SOURCES==========================================================#
     #compute power output of each source, for which the combined cumulative imissions of all sources for each classes are minimal
-    sourcePowerOutputs = ge.minimizeImissions(cumulativeImission)
-    np.set_printoptions(precision=3)
-    print("\n\nOptimal power output for main source: ", sourcePowerOutputs[0])
-    for source in range(1,len(sourcePowerOutputs)):
-        print("Optimal power output for distributed source no.", source, ": ",  sourcePowerOutputs[source])
+    #combined power output constraint is built from nominal power (emission rate) of each source
+    with instrument.span("optimization"):
+        powerShares = ge.powerShareCoef(sourceParams_all)
+        if limitMode:
+            sourcePowerOutputs, optimizerInfo = ge.minimizeImissionsLimited(cumulativeImission, totalConcFields, imissionLimit, powerShares)
+            print("Imission limit:", imissionLimit, ", active nodes:", optimizerInfo["activeNodes"], ", binding nodes:", len(optimizerInfo["bindingNodes"]),
+                  ", iterations:", optimizerInfo["iterations"], ", maximal concentration:", optimizerInfo["maxConcentration"])
+        elif not adaptiveMode:
+            sourcePowerOutputs, optimizerInfo = ge.minimizeImissions(cumulativeImission, powerShares, method=optimizerMethod, fullOutput=True)
+        else:
+            sourcePowerOutputs, adaptiveInfo = ge.minimizeImissionsAdaptive(sourceParams_all, dispersionParams, domainParams, stabilityClass, adaptiveShareTolerance, maxResolution=domainParams[2], powerShares=powerShares, method=optimizerMethod, cacheDir=fieldCacheDir, plumeTolerance=plumeTolerance)
+            optimizerInfo = {"method": optimizerMethod, "solveTime": adaptiveInfo["totalTime"]}
+            print("Adaptive resolution reached:", adaptiveInfo["resolution"], ", converged:", adaptiveInfo["converged"], ", time [s]:", adaptiveInfo["totalTime"])
+        np.set_printoptions(precision=3)
+        print("\n\nOptimal power output for main source: ", sourcePowerOutputs[0])
+        for source in range(1,len(sourcePowerOutputs)):
+            print("Optimal power output for distributed source no.", source, ": ",  sourcePowerOutputs[source])
+        print("Optimization method:", optimizerInfo["method"], ", solve time [s]:", optimizerInfo["solveTime"])
     #=================================/MINIMIZE=CUMULATIVE=IMISSIONS=OF=ALL=SOURCES==========================================================#
 
-    
-    #===============================CREATE=CVS's=AND=GRAPH=FOR=OPTIMAL=POWER=OUTPUT=========================================================#
-    #adjust source power output to optimal values
-    sourceParams_optimal_all = []
-    for source in range(0,len(sourcePowerOutputs)):
-        sourceParams_optimal_all.append(sourceParams_all[source])
-        sourceParams_optimal_all[source][6] = sourcePowerOutputs[source]*sourceParams_all[source][6]
-
-    #and compute total imission concentration with all sources running at this power output (example with stability class A)
-    totalConcField_Optimal = ge.gaussDispEq_TotalConcField(sourceParams_optimal_all[0], dispersionParams, domainParams, "A")
-    for source in range(1, len(sourceParams_optimal_all)):
-        totalConcField_Optimal += ge.gaussDispEq_TotalConcField(sourceParams_optimal_all[source], dispersionParams, domainParams, "A")
-    np.savetxt("./output/imissionConc_optimal.csv", totalConcField_Optimal, delimiter=",")
-    
-    #create graph with optimal imission concentration and save it
-    fileName = 'plot_optimal'
-    title = 'Concentrations for optimal power combination'
-    output.createGraphs(totalConcField_Optimal, fileName, title, domainParams)
-    #===============================/CREATE=CVS's=AND=GRAPH=FOR=OPTIMAL=POWER=OUTPUT=========================================================#
-
-
-    #===============================CREATE=CVS's=AND=GRAPH=FOR=JUST=MAIN=SOURCE=IN=OPERATION================================================#
-    #For comparison print imission concentration for just central heat source in full operation
-    totalConcField_MainSource, totalConcField_SmallSources = ge.totalConcFields_MainSmall(sourceParams_all, dispersionParams, domainParams, "A" )
-    np.savetxt("./output/imissionConc_main.csv", totalConcField_MainSource, delimiter=",")
-    np.savetxt("./output/imissionConc_distributed.csv", totalConcField_SmallSources, delimiter=",")
-    #and create graph and save it
-    fileName = 'plot_main'
-    title = 'Concentrations for main source in operation'
-    output.createGraphs(totalConcField_MainSource, fileName, title, domainParams)
-    #===============================/CREATE=CVS's=AND=GRAPH=FOR=JUST=MAIN=SOURCE=IN=OPERATION================================================#
 
+    #=================================CONCENTRATION=FIELDS=FOR=OUTPUT========================================================================#
+    #total imission concentration (example with stability class A) with all sources running at optimal power output,
+    #with just main source and with just distributed sources in full operation
+    #concentration is linear in emission rate, so these fields are combinations of fields of each source at nominal power
+    with instrument.span("outputFields"):
+        mainSourceOnly = np.eye(len(sourceParams_all))[0]
+        sourceWeights = np.array([sourcePowerOutputs, mainSourceOnly, 1 - mainSourceOnly])
+        if tileRows is None and not adaptiveMode:
+            totalConcField_Optimal, totalConcField_MainSource, totalConcField_SmallSources = np.tensordot(sourceWeights, totalConcFields[fieldClasses.index(stabilityClass[plotClass])], axes=1)
+        elif tileRows is None:
+            #adaptive mode - only output fields are computed at full resolution, not fields of all sources
+            fieldStats = ge.streamImissionStats(sourceParams_all, dispersionParams, domainParams, stabilityClass[plotClass], sourceWeights, returnFields=True)
+            totalConcField_Optimal, totalConcField_MainSource, totalConcField_SmallSources = fieldStats["fields"]
+        else:
+            fieldFiles = ["./output/stream_imissionConc_optimal.npy", "./output/stream_imissionConc_main.npy", "./output/stream_imissionConc_distributed.npy"]
+            fieldStats = ge.streamImissionStats(sourceParams_all, dispersionParams, domainParams, stabilityClass[plotClass], sourceWeights, outputFiles=fieldFiles, tileRows=tileRows)
+            totalConcField_Optimal, totalConcField_MainSource, totalConcField_SmallSources = fieldStats["fields"]
+    #=================================/CONCENTRATION=FIELDS=FOR=OUTPUT=======================================================================#
 
-    #===============================CREATE=CVS's=AND=GRAPH=FOR=JUST=DISTRIBUTED=SOURCES=IN=OPERATION==========================================#
-    #and for distributed heat sources in full opeation (without central source) 
-    fileName = 'plot_distributed'
-    title = 'Concentrations for distributed sources in operation'
-    output.createGraphs(totalConcField_SmallSources, fileName, title, domainParams)
-    #===============================/CREATE=CVS's=AND=GRAPH=FOR=JUST=DISTRIBUTED=SOURCES=IN=OPERATION==========================================#
-
-
-
-   
\ No newline at end of file
+    
+    #===============================SAVE=CONCENTRATION=FIELDS===============================================================================#
+    with instrument.span("saveFields"):
+        for fieldName, concField in [("optimal", totalConcField_Optimal), ("main", totalConcField_MainSource), ("distributed", totalConcField_SmallSources)]:
+            metadata = output.fieldMetadata(domainParams, stabilityClass[plotClass], sourceFolder, field=fieldName)
+            output.saveField(concField, "./output/imissionConc_" + fieldName, outputFormat, outputFloat32, outputCompress, metadata)
+            if csvExport and outputFormat != "csv":
+                output.saveField(concField, "./output/imissionConc_" + fieldName, "csv", metadata=metadata)
+    #===============================/SAVE=CONCENTRATION=FIELDS==============================================================================#
+
+
+    #===============================CREATE=GRAPHS=============================================================================================#
+    #create graphs with imission concentrations for optimal power combination, for just central heat source in full operation
+    #and for distributed heat sources in full opeation (without central source) and save them
+    with instrument.span("graphs"):
+        if createPlots:
+            #memory-mapped fields of streaming mode are given by file names (workers map the files, fields are not copied)
+            plotFields = fieldFiles if tileRows is not None else [totalConcField_Optimal, totalConcField_MainSource, totalConcField_SmallSources]
+            graphs = [(plotFields[0], 'plot_optimal', 'Concentrations for optimal power combination'),
+                      (plotFields[1], 'plot_main', 'Concentrations for main source in operation'),
+                      (plotFields[2], 'plot_distributed', 'Concentrations for distributed sources in operation')]
+            output.renderGraphs(graphs, domainParams, workers=plotWorkers)
+    #===============================/CREATE=GRAPHS============================================================================================#
+
+
+    #===============================CONCENTRATIONS=IN=RECEPTOR=POINTS=========================================================================#
+    #concentrations in receptor points for all sources running at optimal power output, for each stability class
+    with instrument.span("receptors"):
+        if receptorFile is not None:
+            receptors, receptorNames = getinput.getReceptorData(receptorFile)
+            receptorConc = np.tensordot(ge.gaussDispEqReceptors(sourceParams_all, dispersionParams, domainParams, stabilityClass, receptors), sourcePowerOutputs, axes=([1],[0]))
+            np.savetxt("./output/imissionConc_receptors.csv", receptorConc.T, delimiter=",", header=",".join(stabilityClass), comments="")
+            for receptor in range(len(receptorNames)):
+                print("Concentrations in receptor", receptorNames[receptor], "for stability classes", stabilityClass, ": ", receptorConc[:,receptor])
+    #===============================/CONCENTRATIONS=IN=RECEPTOR=POINTS========================================================================#
+
+
+    #===============================ANNUAL=STATISTICS=FROM=HOURLY=METEOROLOGICAL=TIME=SERIES==================================================#
+    #evaluate each hour of the time series for all sources running at optimal power output
+    #and create annual mean, maximum and percentile of hourly concentrations
+    with instrument.span("annualStatistics"):
+        if meteoFile is not None:
+            sourceParams_optimal_all = [list(sourceParams_all[source][0:6]) + [sourcePowerOutputs[source]*sourceParams_all[source][6]] for source in range(len(sourceParams_all))]
+            if workerCount == 1:
+                meteoAcc = timeseries.runMeteoSeries(meteoFile, sourceParams_optimal_all, domainParams, meteoQuantile)
+            else:
+                meteoAcc = timeseries.runMeteoSeriesParallel(meteoFile, sourceParams_optimal_all, domainParams, meteoQuantile, workers=workerCount)
+            annualStats = timeseries.annualStats(meteoAcc, meteoQuantile)
+            print("Hours of meteorological time series evaluated:", annualStats["records"])
+            #more hours than expected - percentile is not exact, but its conservative upper bound (see timeseries.annualStats)
+            percentileTitle = "Annual " + str(100*meteoQuantile) + " percentile of concentrations"
+            if not annualStats["exact"]:
+                print("WARNING: more hours than expected were evaluated, annual", 100*meteoQuantile, "percentile is an upper bound (conservative), not exact value")
+                percentileTitle += " (upper bound)"
+            graphs = []
+            for statName, statTitle in [("mean", "Annual mean concentrations"), ("max", "Annual maximum concentrations"), ("percentile", percentileTitle)]:
+                metadata = output.fieldMetadata(domainParams, None, sourceFolder, field="annual_" + statName, records=annualStats["records"], quantile=meteoQuantile)
+                if statName == "percentile":
+                    metadata["exact"] = bool(annualStats["exact"])
+                output.saveField(annualStats[statName], "./output/imissionConc_annual_" + statName, outputFormat, outputFloat32, outputCompress, metadata)
+                if csvExport and outputFormat != "csv":
+                    output.saveField(annualStats[statName], "./output/imissionConc_annual_" + statName, "csv", metadata=metadata)
+                graphs.append((annualStats[statName], "plot_annual_" + statName, statTitle + " for optimal power combination"))
+            if createPlots:
+                output.renderGraphs(graphs, domainParams, workers=plotWorkers)
+    #===============================/ANNUAL=STATISTICS=FROM=HOURLY=METEOROLOGICAL=TIME=SERIES=================================================#
+
+
+    if args.profile:
+        instrument.disable()
+        instrument.writeReport(args.profile, scenario=sourceFolder, resolution=domainParams[2], sourceCount=len(sourceParams_all),
+                               stabilityClasses=stabilityClass, workers=workerCount, optimizerMethod=optimizerInfo["method"])
+        print("Run report written to", args.profile)
@@ -0,0 +1,31 @@
+from lib import getinput
+from lib import sweep
+
+
+#==================================================INPUT==============================================================================#
+#Sweep over scenario folders and values of swept parameters (all combinations, see sweep.expandGrid and sweep.sweepParams)
+#Fields shared by several scenarios are computed only once, results of all scenarios are written into one summary table
+scenarioFolders = getinput.discoverScenarios("./input/")
+paramGrid = {"windSpeed": [1.2, 2.4, 3.6]}
+#==================================================/INPUT==============================================================================#
+
+#==================================================PARAMETERS==============================================================================#
+stabilityClass = ["A", "B", "C", "D", "E", "F"]
+#folder for persistent cache of computed fields at unit emission (None = fields are not stored)
+fieldCacheDir = None
+#relative tolerance for evaluation of each plume only inside its wedge (None = evaluate all nodes of the domain)
+plumeTolerance = None
+#number of worker processes (None = number of CPUs)
+workerCount = None
+#optimization method for ge.minimizeImissions ("linprog" or original "trust-constr")
+optimizerMethod = "linprog"
+summaryFile = "./output/sweep_summary.csv"
+#==================================================/PARAMETERS==============================================================================#
+
+
+if __name__ == "__main__":
+    scenarios = sweep.expandGrid(scenarioFolders, paramGrid)
+    results = sweep.runSweep(scenarios, stabilityClass, cacheDir=fieldCacheDir, tolerance=plumeTolerance, method=optimizerMethod, workers=workerCount, summaryFile=summaryFile)
+    for result in results:
+        shares = [result["share_" + str(source)] for source in range(result["sourceCount"])]
+        print(result["name"], ": optimal power outputs", [round(share, 3) for share in shares], ", cumulative imission", result["cumulativeImission_optimal"])